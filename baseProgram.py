@@ -4,7 +4,11 @@
 # see LICENSE.txt for the text of the lincense
 
 from gurobipy import *
+import instrumentation
 import isxJRChecker
+import logging
+import math
+import time
 
 CANDIDATE_VARIABLE_NAME="cc"
 COVERAGE_VARIABLE_NAME="coverage"
@@ -24,12 +28,18 @@ def compute(candidates, voters, lab, uab, lcb, ucb, committeeSize,
     goal=COMM_OF_GIVEN_SIZE, requireJR=True):
 
   try:
-    m = _basicModel(candidates, voters, lab, uab, lcb, ucb, committeeSize, goal, requireJR)
-    m.optimize()
+    with instrumentation.phase("build"):
+      m = _basicModel(candidates, voters, lab, uab, lcb, ucb, committeeSize, goal, requireJR)
+    with instrumentation.phase("solve"):
+      m.optimize()
+    instrumentation.recordModel(m)
     
     if not m.Status == GRB.OPTIMAL:
       return False, None
     else:
+      if instrumentation.isRecording():
+        instrumentation.recordCommittee([candId for candId in candidates if int(round(
+          m.getVarByName("{}[{}]".format(CANDIDATE_VARIABLE_NAME, candId)).X,0)) == 1])
       return True, int(m.objVal)
   except GurobiError:
     print('Error reported')
@@ -42,6 +52,7 @@ def computePJR(candidates, voters, lab, uab, lcb, ucb, committeeSize):
 
 def compute_pav(candidates, voters, lab, uab, lcb, ucb, committeeSize, satisfactionLevel = None):
   try:
+    buildStartTime = time.perf_counter()
     m = Model("MaxApproval")
     m.setParam('OutputFlag', False )
 
@@ -98,12 +109,17 @@ def compute_pav(candidates, voters, lab, uab, lcb, ucb, committeeSize, satisfact
       m.setObjective(satisfactionVar, GRB.MAXIMIZE)
     else:
       m.addConstr(satisfactionVar == satisfactionLevel)
+    instrumentation.addTime("build", time.perf_counter() - buildStartTime)
 
-    m.optimize()
+    with instrumentation.phase("solve"):
+      m.optimize()
+    instrumentation.recordModel(m)
 
     if not m.Status == GRB.OPTIMAL:
       return False, None, indicatorVCOVars, None, None
     else:
+      instrumentation.recordCommittee([candId for candId, candVar in candidateVars.items()
+        if int(round(candVar.X,0)) == 1])
       return True, m.objVal, indicatorVCOVars, coverageVar.X, approvalScoreVar.X
 
   except GurobiError as GErr:
@@ -179,7 +195,7 @@ def _basicModel(candidates, voters, lab, uab, lcb, ucb, committeeSize, goal, req
   except GurobiError as GErr:
     print('Error reported: {}'.format(GErr))
 
-def _computeEJRorPJR(candidates, voters, lab, uab, lcb, ucb, committeeSize, whatToCompute,
+def computeEJRorPJR(candidates, voters, lab, uab, lcb, ucb, committeeSize, whatToCompute,
     goal=COMM_OF_GIVEN_SIZE):
   xJRCheckers = {
         COMPUTE_EJR: isxJRChecker.isEJR_ilp,
@@ -190,9 +206,12 @@ def _computeEJRorPJR(candidates, voters, lab, uab, lcb, ucb, committeeSize, what
 
   
   try:
-    m = _basicModel(candidates, voters, lab, uab, lcb, ucb, committeeSize, goal, True)
+    with instrumentation.phase("build"):
+      m = _basicModel(candidates, voters, lab, uab, lcb, ucb, committeeSize, goal, True)
     while True:
-      m.optimize()
+      with instrumentation.phase("solve"):
+        m.optimize()
+      instrumentation.recordModel(m)
       if not m.Status == GRB.OPTIMAL:
         return False, None
       else:
@@ -207,9 +226,149 @@ def _computeEJRorPJR(candidates, voters, lab, uab, lcb, ucb, committeeSize, what
         votersAsBinaryMatr = isxJRChecker.appListsProfilesToBinaryMatrix(voters.values(),
             candidates)
         if xJRCheckers[whatToCompute](votersAsBinaryMatr, committee):
+          instrumentation.recordCommittee(committee)
           return True, int(m.objVal)
         m.addConstr(quicksum(committeeVars) <= len(committeeVars)-1)
+        instrumentation.count("cutIterations")
   except GurobiError as e:
     print('Error reported: ' + str(e))
 
 
+
+
+class SweepModel(object):
+  """The model of _basicModel built once per profile and reused across cells
+  and committee sizes: the committee size (with the JR bounds), whether JR
+  is required, the cell bounds, the goal and a MIP start are changed in
+  place. Cuts excluding committees that failed the EJR/PJR check are kept
+  until the committee size changes."""
+
+  def __init__(self, candidates, voters, maxCommitteeSize, requireJR):
+    self._candidates = candidates
+    self._voters = voters
+    self._committeeSize = maxCommitteeSize
+    self._requireJR = requireJR
+    self._cuts = []
+    self._votersAsBinaryMatr = None
+    try:
+      m = Model("MaxApproval")
+      m.setParam('OutputFlag', False )
+
+      self._candidateVars = m.addVars(candidates, name=CANDIDATE_VARIABLE_NAME, vtype=GRB.BINARY)
+
+      voterVars = m.addVars(voters.keys(), name="vr", vtype=GRB.CONTINUOUS, lb=0.0, ub=1.0)
+
+      self._coreSizeVar = m.addVar(name="coreSize", vtype=GRB.INTEGER, lb=0, ub=maxCommitteeSize)
+
+      self._approvalScoreVar = m.addVar(name=APPROVAL_VARIABLE_NAME, vtype=GRB.INTEGER, lb=1)
+
+      self._coverageVar = m.addVar(name=COVERAGE_VARIABLE_NAME, vtype=GRB.INTEGER, lb=1)
+
+      self._coreSizeConstr = m.addConstr(self._coreSizeVar == maxCommitteeSize)
+
+      m.addConstr(quicksum(self._candidateVars[i] for i in candidates) == self._coreSizeVar)
+      m.addConstrs((voterVars[j] <= quicksum(self._candidateVars[i] for i in voters[j])) for j in voters.keys())
+      m.addConstrs((voterVars[j] >= self._candidateVars[i]) for j in voters.keys() for i in voters[j])
+
+      # sum over approvers of (1 - vr) <= s, kept as sum of vr >= approvers - s
+      # so that only the right-hand side depends on the committee size (and
+      # on whether JR is required at all; a right-hand side of 0 is void)
+      self._jrConstrs = []
+      for i in candidates:
+        approvers = [j for j in voters.keys() if i in voters[j]]
+        self._jrConstrs.append((m.addConstr(quicksum(voterVars[j] for j in approvers) >= 0),
+          len(approvers)))
+
+      m.addConstr(self._coverageVar == quicksum(voterVars[j] for j in voters.keys()))
+
+      self._coverageUB = m.addConstr(self._coverageVar <= len(voters))
+      self._coverageLB = m.addConstr(self._coverageVar >= 1)
+
+      m.addConstr(self._approvalScoreVar == (quicksum(quicksum(self._candidateVars[i] for j in
+        voters.keys() if i in voters[j]) for i in candidates)))
+
+      self._approvalUB = m.addConstr(self._approvalScoreVar <= maxCommitteeSize*len(voters))
+      self._approvalLB = m.addConstr(self._approvalScoreVar >= 1)
+
+      self._model = m
+      self.setCommitteeSize(maxCommitteeSize)
+      self.setGoal(COMM_OF_GIVEN_SIZE)
+
+    except GurobiError as GErr:
+      print('Error reported: {}'.format(GErr))
+
+  def setCommitteeSize(self, committeeSize):
+    if committeeSize != self._committeeSize:
+      for cut in self._cuts:
+        self._model.remove(cut)
+      self._cuts = []
+    self._committeeSize = committeeSize
+    self._coreSizeVar.UB = committeeSize
+    self._coreSizeConstr.RHS = committeeSize
+    self._updateJRConstrs()
+
+  def setRequireJR(self, requireJR):
+    self._requireJR = requireJR
+    self._updateJRConstrs()
+
+  def _updateJRConstrs(self):
+    smallerThanCohesiveSize = int(math.ceil(float(len(self._voters))/float(self._committeeSize)-1))
+    for constr, approversCount in self._jrConstrs:
+      constr.RHS = approversCount - smallerThanCohesiveSize if self._requireJR else 0
+
+  def setCell(self, lab, uab, lcb, ucb):
+    self._approvalLB.RHS = lab
+    self._approvalUB.RHS = uab
+    self._coverageLB.RHS = lcb
+    self._coverageUB.RHS = ucb
+
+  def setGoal(self, goal):
+    if goal==COMM_OF_GIVEN_SIZE or goal==CORE_MIN:
+      self._model.setObjective(self._coreSizeVar, GRB.MINIMIZE)
+    if goal==APPROVAL_MAX:
+      self._model.setObjective(self._approvalScoreVar, GRB.MAXIMIZE)
+    if goal==APPROVAL_MIN:
+      self._model.setObjective(self._approvalScoreVar, GRB.MINIMIZE)
+    if goal==COVERAGE_MAX:
+      self._model.setObjective(self._coverageVar, GRB.MAXIMIZE)
+    if goal==COVERAGE_MIN:
+      self._model.setObjective(self._coverageVar, GRB.MINIMIZE)
+
+  def setStart(self, committee):
+    committee = set(committee)
+    for candId, candVar in self._candidateVars.items():
+      candVar.Start = 1 if candId in committee else 0
+
+  def solve(self, whatToCompute=None):
+    """Returns (feasible, objective, committee); with whatToCompute set to
+    COMPUTE_EJR or COMPUTE_PJR only committees passing the check count"""
+    xJRCheckers = {
+          COMPUTE_EJR: isxJRChecker.isEJR_ilp,
+          COMPUTE_PJR: isxJRChecker.isPJR_ilp
+        }
+    try:
+      while True:
+        with instrumentation.phase("solve"):
+          self._model.optimize()
+        instrumentation.recordModel(self._model)
+        if not self._model.Status == GRB.OPTIMAL:
+          return False, None, None
+        committee = []
+        committeeVars = []
+        for candId, candVar in self._candidateVars.items():
+          if int(round(candVar.X,0)) == 1:
+            committee.append(candId)
+            committeeVars.append(candVar)
+        if whatToCompute is None:
+          instrumentation.recordCommittee(committee)
+          return True, int(self._model.objVal), committee
+        if self._votersAsBinaryMatr is None:
+          self._votersAsBinaryMatr = isxJRChecker.appListsProfilesToBinaryMatrix(
+              self._voters.values(), self._candidates)
+        if xJRCheckers[whatToCompute](self._votersAsBinaryMatr, committee):
+          instrumentation.recordCommittee(committee)
+          return True, int(self._model.objVal), committee
+        self._cuts.append(self._model.addConstr(quicksum(committeeVars) <= len(committeeVars)-1))
+        instrumentation.count("cutIterations")
+    except GurobiError as e:
+      print('Error reported: ' + str(e))
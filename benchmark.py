@@ -0,0 +1,266 @@
+#!/usr/bin/python3
+
+# copyright 2020 Andrzej Kaczmarczyk (andrzej >dot> kaczmarczyk <at> agh.edu.pl; a <dot> kaczmarczyk <at> tu-berlin.de)
+# This file is part of mul-win-just-pub.
+# mul-win-just-pub is licensed under the terms of MIT license
+# see LICENSE.txt for the text of the lincense
+
+"""Scaling benchmark of the generators, the xJR checkers and the rules.
+
+Every case runs on a seeded profile in a fresh process, so it is not
+affected by the other cases. Only the measured call is timed, and its memory
+is the growth of the peak resident set size over the resident set size
+before the call (the interpreter, imports and the profile are excluded).
+Results can be stored as a baseline and later runs compared against it. The PuLP-based
+checkers run on CBC by default; cases of the rules need gurobipy and are
+reported as skipped when it is not available."""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import resource
+import sys
+import time
+import numpy as np
+import distributions
+
+PRESETS = {
+  "smoke": {"voters": [100], "candidates": [10], "committeeSizes": [2], "timeout": None},
+  "full": {"voters": [100, 1000, 10000, 100000], "candidates": [10, 50, 200],
+    "committeeSizes": [2, 5, 10, 20], "timeout": 600.0},
+}
+
+GENERATORS = {
+  "MallowsModel": lambda seed: distributions.MallowsModel(0.8, 5, seed=seed),
+  "EqualChooseDistribution": lambda seed: distributions.EqualChooseDistribution(0.2, seed=seed),
+  "OneDDistribution": lambda seed: distributions.OneDDistribution(0.05, seed=seed),
+  "TwoDDistribution": lambda seed: distributions.TwoDDistribution(0.2, seed=seed),
+  "UrnModel": lambda seed: distributions.UrnModel(0.2, 1, seed=seed),
+}
+
+CHECKERS = ["isJR", "isEJR_ilp", "isPJR_ilp", "xJRChecking"]
+
+RULES = ["JRCommittee", "PJRCommittee", "AnyCommittee", "MaxApprovalCommittee",
+  "ChambelinCourantCommittee", "PAV", "SinglePAV", "SequentialPhragmen"]
+
+MESH_PARTS = 3
+
+class Case(object):
+  def __init__(self, kind, name, votersNr, candidatesNr, committeeSize, seed):
+    self.kind = kind
+    self.name = name
+    self.votersNr = votersNr
+    self.candidatesNr = candidatesNr
+    self.committeeSize = committeeSize
+    self.seed = seed
+
+  def key(self):
+    if self.kind == "generator":
+      return "{}:{}:n={}:m={}".format(self.kind, self.name, self.votersNr, self.candidatesNr)
+    return "{}:{}:n={}:m={}:k={}".format(self.kind, self.name, self.votersNr,
+      self.candidatesNr, self.committeeSize)
+
+def buildCases(kinds, votersNrs, candidatesNrs, committeeSizes, seed):
+  cases = []
+  for votersNr, candidatesNr in itertools.product(votersNrs, candidatesNrs):
+    if "generator" in kinds:
+      cases.extend(Case("generator", name, votersNr, candidatesNr, None, seed)
+        for name in GENERATORS)
+    for committeeSize in committeeSizes:
+      if committeeSize > candidatesNr:
+        continue
+      if "checker" in kinds:
+        cases.extend(Case("checker", name, votersNr, candidatesNr, committeeSize, seed)
+          for name in CHECKERS)
+      if "rule" in kinds:
+        cases.extend(Case("rule", name, votersNr, candidatesNr, committeeSize, seed)
+          for name in RULES)
+  return cases
+
+def _profile(case):
+  generator = distributions.EqualChooseDistribution(0.2, seed=case.seed)
+  return generator.generate(list(range(case.candidatesNr)), case.votersNr)
+
+def _prepareGenerator(case):
+  generator = GENERATORS[case.name](case.seed)
+  return lambda: generator.generateMatrix(list(range(case.candidatesNr)), case.votersNr)
+
+def _prepareChecker(case, solverName):
+  import isxJRChecker
+  import pulp
+  if solverName == "cbc":
+    isxJRChecker.setSolver(pulp.PULP_CBC_CMD(msg=0))
+  candidates, voters = _profile(case)
+  committee = np.random.default_rng(case.seed).choice(case.candidatesNr, case.committeeSize,
+    replace=False).tolist()
+  def check():
+    V = isxJRChecker.appListsProfilesToBinaryMatrix(voters.values(), candidates)
+    getattr(isxJRChecker, case.name)(V, committee)
+  return check
+
+def _prepareRule(case):
+  import rules
+  import tools
+  candidates, voters = _profile(case)
+  def computeRule():
+    stats = rules.ProfileStats(candidates, voters, case.committeeSize)
+    mesh = tools.Mesh(len(candidates), len(voters), case.committeeSize, MESH_PARTS, MESH_PARTS)
+    getattr(rules, case.name)().compute(candidates, voters, mesh, stats, "X")
+  return computeRule
+
+def _residentKB():
+  """The current resident set size (the peak one where /proc is missing)"""
+  try:
+    with open("/proc/self/statm", 'r') as infile:
+      return int(infile.read().split()[1])*resource.getpagesize()//1024
+  except OSError:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _resetPeakResident():
+  """Resets the peak resident set size of the process (Linux >= 4.0);
+  returns False when it is not possible"""
+  try:
+    with open("/proc/self/clear_refs", 'w') as outfile:
+      outfile.write("5")
+    return True
+  except OSError:
+    return False
+
+def _peakResidentKB():
+  try:
+    with open("/proc/self/status", 'r') as infile:
+      for line in infile:
+        if line.startswith("VmHWM:"):
+          return int(line.split()[1])
+  except OSError:
+    pass
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def runCase(case, solverName):
+  """Runs a single case in the current process; returns a result dict"""
+  try:
+    if case.kind == "generator":
+      call = _prepareGenerator(case)
+    elif case.kind == "checker":
+      call = _prepareChecker(case, solverName)
+    else:
+      call = _prepareRule(case)
+    residentBefore = _residentKB()
+    _resetPeakResident()
+    startTime = time.perf_counter()
+    call()
+    elapsed = time.perf_counter() - startTime
+    peak = _peakResidentKB()
+  except ImportError as error:
+    return {"status": "skipped", "reason": str(error)}
+  except (Exception, SystemExit) as error:
+    return {"status": "error", "reason": repr(error)}
+  return {"status": "ok", "time": elapsed, "peakMemoryKB": max(peak - residentBefore, 0)}
+
+def runCaseIsolated(case, solverName, timeout):
+  pool = multiprocessing.Pool(1)
+  try:
+    return pool.apply_async(runCase, (case, solverName)).get(timeout)
+  except multiprocessing.TimeoutError:
+    return {"status": "timeout", "reason": "exceeded {}s".format(timeout)}
+  finally:
+    pool.terminate()
+    pool.join()
+
+def runBenchmark(cases, solverName="cbc", repeat=1, timeout=None, outStream=None):
+  """Returns a case key -> result dict; time is the minimum over repeats and
+  peak memory (growth during the measured call) the maximum"""
+  results = {}
+  for case in cases:
+    best = None
+    for _ in range(repeat):
+      result = runCaseIsolated(case, solverName, timeout)
+      if result["status"] != "ok":
+        best = result
+        break
+      if best is None:
+        best = result
+      else:
+        best = {"status": "ok", "time": min(best["time"], result["time"]),
+          "peakMemoryKB": max(best["peakMemoryKB"], result["peakMemoryKB"])}
+    results[case.key()] = best
+    if outStream is not None:
+      outStream.write("{:<60} {}\n".format(case.key(), _formatResult(best)))
+      outStream.flush()
+  return results
+
+def _formatResult(result):
+  if result["status"] != "ok":
+    return "{} ({})".format(result["status"], result["reason"])
+  return "{:10.4f}s {:10d}KB".format(result["time"], result["peakMemoryKB"])
+
+def compareWithBaseline(results, baseline, tolerance, minTimeDelta=0.0, minMemoryDeltaKB=0):
+  """Returns a list of (case key, description) of the cases that got slower
+  or use more memory than the baseline by more than tolerance (a fraction)
+  and, so that timer and allocator noise of tiny cases is not reported, by
+  more than minTimeDelta seconds or minMemoryDeltaKB respectively"""
+  regressions = []
+  for key, result in sorted(results.items()):
+    previous = baseline.get(key)
+    if previous is None or previous["status"] != "ok":
+      continue
+    if result["status"] != "ok":
+      regressions.append((key, "was ok, now {}".format(result["status"])))
+      continue
+    if (result["time"] > previous["time"]*(1 + tolerance)
+        and result["time"] - previous["time"] > minTimeDelta):
+      regressions.append((key, "time {:.4f}s -> {:.4f}s".format(previous["time"], result["time"])))
+    if (result["peakMemoryKB"] > previous["peakMemoryKB"]*(1 + tolerance)
+        and result["peakMemoryKB"] - previous["peakMemoryKB"] > minMemoryDeltaKB):
+      regressions.append((key, "peak memory {}KB -> {}KB".format(previous["peakMemoryKB"],
+        result["peakMemoryKB"])))
+  return regressions
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Scaling benchmark of generators, "
+    "xJR checkers and rules")
+  parser.add_argument("--preset", choices=sorted(PRESETS), default="smoke")
+  parser.add_argument("--kinds", nargs="+", choices=["generator", "checker", "rule"],
+    default=["generator", "checker", "rule"])
+  parser.add_argument("--voters", type=int, nargs="+", help="overrides the preset")
+  parser.add_argument("--candidates", type=int, nargs="+", help="overrides the preset")
+  parser.add_argument("--committee-sizes", type=int, nargs="+", help="overrides the preset")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--repeat", type=int, default=3,
+    help="runs per case; the fastest one is reported")
+  parser.add_argument("--timeout", type=float,
+    help="seconds per case; by default none for smoke and 600 for full")
+  parser.add_argument("--solver", choices=["cbc", "gurobi"], default="cbc",
+    help="PuLP solver of the xJR checkers")
+  parser.add_argument("--baseline", help="JSON file with results to compare against")
+  parser.add_argument("--tolerance", type=float, default=0.25,
+    help="allowed relative slowdown or memory growth")
+  parser.add_argument("--min-time-delta", type=float, default=0.01,
+    help="slowdowns of at most this many seconds are never regressions")
+  parser.add_argument("--min-memory-delta-kb", type=int, default=1024,
+    help="peak memory growth of at most this many KB is never a regression")
+  parser.add_argument("--save", help="stores the results as JSON (e.g. a new baseline)")
+  args = parser.parse_args(argv)
+
+  preset = PRESETS[args.preset]
+  cases = buildCases(args.kinds, args.voters or preset["voters"],
+    args.candidates or preset["candidates"], args.committee_sizes or preset["committeeSizes"],
+    args.seed)
+  timeout = args.timeout if args.timeout is not None else preset["timeout"]
+  results = runBenchmark(cases, args.solver, args.repeat, timeout, sys.stdout)
+  if args.save:
+    with open(args.save, 'w') as outfile:
+      json.dump(results, outfile, indent=1, sort_keys=True)
+  if args.baseline:
+    with open(args.baseline, 'r') as infile:
+      regressions = compareWithBaseline(results, json.load(infile), args.tolerance,
+        args.min_time_delta, args.min_memory_delta_kb)
+    for key, description in regressions:
+      print("REGRESSION {}: {}".format(key, description))
+    if regressions:
+      return 1
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,299 @@
+#!/usr/bin/python3
+
+# copyright 2020 Andrzej Kaczmarczyk (andrzej >dot> kaczmarczyk <at> agh.edu.pl; a <dot> kaczmarczyk <at> tu-berlin.de)
+# This file is part of mul-win-just-pub.
+# mul-win-just-pub is licensed under the terms of MIT license
+# see LICENSE.txt for the text of the lincense
+
+"""Coordinator/worker mode for mesh sweeps based on a shared SQLite queue.
+
+The coordinator prepares a mesh (see rules.MeshRule.prepare) and puts its
+unclipped cells into the queue together with the pickled profile and rule.
+Workers, started on any node that sees the queue file (the filesystem has to
+support locking), lease cells, decide them with the rule and store the
+verdicts; the coordinator copies the verdicts into its Mesh. Cells whose
+lease expired (e.g. the worker died; live workers keep renewing the leases
+of the cells they decide) are handed out again, up to maxAttempts
+times; cells whose decision raised are marked as failed with the traceback,
+and the coordinator then raises CellTaskError.
+
+  python cellQueue.py worker QUEUE_PATH [--lease-timeout S] [--poll-interval S]
+
+test_cellQueue.py compares distributed and in-process meshes."""
+
+import argparse
+import json
+import multiprocessing
+import os
+import pickle
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS submissions (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  rule BLOB NOT NULL,
+  profile BLOB NOT NULL,
+  committeeSize INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS tasks (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  submission INTEGER NOT NULL REFERENCES submissions(id),
+  cell TEXT NOT NULL,
+  status TEXT NOT NULL,
+  worker TEXT,
+  leaseExpires REAL,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  exists_ INTEGER,
+  record TEXT,
+  error TEXT);
+CREATE INDEX IF NOT EXISTS tasksStatus ON tasks(status, leaseExpires);
+CREATE INDEX IF NOT EXISTS tasksSubmission ON tasks(submission, status);
+"""
+
+class CellTaskError(RuntimeError):
+  pass
+
+class CellQueue(object):
+  def __init__(self, queuePath, leaseTimeout=600.0, maxAttempts=3):
+    self.queuePath = queuePath
+    self.leaseTimeout = leaseTimeout
+    self.maxAttempts = maxAttempts
+    self._connection = sqlite3.connect(queuePath, timeout=60.0, isolation_level=None)
+    self._connection.executescript(_SCHEMA)
+    self._profiles = {}
+
+  def close(self):
+    self._connection.close()
+
+  def submit(self, rule, candidates, voters, mesh, stats, existenceSymbol):
+    """Prepares the mesh with the rule and enqueues its unclipped cells;
+    returns the id of the submission"""
+    rule.prepare(candidates, voters, mesh, stats, existenceSymbol)
+    with self._transaction() as cursor:
+      cursor.execute("INSERT INTO submissions (rule, profile, committeeSize) VALUES (?, ?, ?)",
+          (pickle.dumps(rule), pickle.dumps((candidates, voters)), mesh.committeeSize))
+      submissionId = cursor.lastrowid
+      cursor.executemany("INSERT INTO tasks (submission, cell, status) VALUES (?, ?, ?)",
+          [(submissionId, json.dumps(cell), PENDING) for cell in mesh.getUnclippedCells()])
+    return submissionId
+
+  def claim(self, workerId):
+    """Leases the first pending (or expired) cell; returns (task id,
+    submission id, cell) or None when there is nothing to lease. Expired
+    cells leased maxAttempts times already are marked as failed instead."""
+    now = time.time()
+    with self._transaction() as cursor:
+      cursor.execute("UPDATE tasks SET status = ?, error = ?, leaseExpires = NULL WHERE "
+          "status = ? AND leaseExpires < ? AND attempts >= ?",
+          (FAILED, "lease expired {} times".format(self.maxAttempts), LEASED, now,
+            self.maxAttempts))
+      row = cursor.execute("SELECT id, submission, cell FROM tasks WHERE status = ? OR "
+          "(status = ? AND leaseExpires < ?) ORDER BY id LIMIT 1",
+          (PENDING, LEASED, now)).fetchone()
+      if row is None:
+        return None
+      cursor.execute("UPDATE tasks SET status = ?, worker = ?, leaseExpires = ?, "
+          "attempts = attempts + 1 WHERE id = ?", (LEASED, workerId, now + self.leaseTimeout, row[0]))
+    taskId, submissionId, cell = row
+    return taskId, submissionId, tuple(json.loads(cell))
+
+  def renew(self, taskId, workerId):
+    """Extends the lease of a cell still being decided by the worker"""
+    with self._transaction() as cursor:
+      cursor.execute("UPDATE tasks SET leaseExpires = ? WHERE id = ? AND worker = ? AND "
+          "status = ?", (time.time() + self.leaseTimeout, taskId, workerId, LEASED))
+
+  def complete(self, taskId, exists, record):
+    with self._transaction() as cursor:
+      cursor.execute("UPDATE tasks SET status = ?, exists_ = ?, record = ?, leaseExpires = NULL "
+          "WHERE id = ? AND status != ?", (DONE, int(exists), json.dumps(record), taskId, DONE))
+
+  def fail(self, taskId, error):
+    with self._transaction() as cursor:
+      cursor.execute("UPDATE tasks SET status = ?, error = ?, leaseExpires = NULL "
+          "WHERE id = ? AND status != ?", (FAILED, error, taskId, DONE))
+
+  def loadSubmission(self, submissionId):
+    """Returns (rule, candidates, voters, committee size), unpickled once per
+    submission"""
+    if submissionId not in self._profiles:
+      rule, profile, committeeSize = self._connection.execute(
+          "SELECT rule, profile, committeeSize FROM submissions WHERE id = ?",
+          (submissionId,)).fetchone()
+      candidates, voters = pickle.loads(profile)
+      self._profiles[submissionId] = (pickle.loads(rule), candidates, voters, committeeSize)
+    return self._profiles[submissionId]
+
+  def unfinishedCount(self, submissionId=None):
+    """Number of pending or leased cells (of the submission or of all)"""
+    if submissionId is None:
+      return self._connection.execute("SELECT COUNT(*) FROM tasks WHERE status IN (?, ?)",
+          (PENDING, LEASED)).fetchone()[0]
+    return self._connection.execute("SELECT COUNT(*) FROM tasks WHERE submission = ? AND "
+        "status IN (?, ?)", (submissionId, PENDING, LEASED)).fetchone()[0]
+
+  def failures(self, submissionId):
+    """Returns (cell, error) pairs of the failed cells of the submission"""
+    rows = self._connection.execute("SELECT cell, error FROM tasks WHERE submission = ? AND "
+        "status = ? ORDER BY id", (submissionId, FAILED)).fetchall()
+    return [(tuple(json.loads(cell)), error) for cell, error in rows]
+
+  def collect(self, submissionId, mesh, existenceSymbol, collected):
+    """Copies verdicts of the submission not yet in collected (a set of task
+    ids, updated in place) into the mesh and passes their records to the
+    instrumentation hooks; returns the number of unfinished cells"""
+    rows = self._connection.execute("SELECT id, cell, exists_, record FROM tasks WHERE "
+        "submission = ? AND status = ?", (submissionId, DONE)).fetchall()
+    rule = self.loadSubmission(submissionId)[0]
+    for taskId, cell, exists, record in rows:
+      if taskId in collected:
+        continue
+      collected.add(taskId)
+      rule.setVerdict(mesh, tuple(json.loads(cell)), exists, existenceSymbol, json.loads(record))
+    return self.unfinishedCount(submissionId)
+
+  def _transaction(self):
+    return _Transaction(self._connection)
+
+class _Transaction(object):
+  def __init__(self, connection):
+    self._connection = connection
+
+  def __enter__(self):
+    self._connection.execute("BEGIN IMMEDIATE")
+    return self._connection.cursor()
+
+  def __exit__(self, excType, excValue, traceback):
+    self._connection.execute("COMMIT" if excType is None else "ROLLBACK")
+    return False
+
+class _LeaseHeartbeat(object):
+  """Renews, every leaseTimeout/3 seconds, the lease of the cell the worker
+  is currently deciding, so that cells taking longer than leaseTimeout are
+  not handed out again while their worker is alive. Uses its own
+  connection as sqlite connections cannot be shared between threads."""
+  def __init__(self, queuePath, leaseTimeout, workerId):
+    self._queuePath = queuePath
+    self._leaseTimeout = leaseTimeout
+    self._workerId = workerId
+    self.taskId = None
+    self._stopped = threading.Event()
+    self._thread = threading.Thread(target=self._run, daemon=True)
+
+  def start(self):
+    self._thread.start()
+
+  def stop(self):
+    self._stopped.set()
+    self._thread.join()
+
+  def _run(self):
+    queue = CellQueue(self._queuePath, self._leaseTimeout)
+    try:
+      while not self._stopped.wait(self._leaseTimeout/3):
+        taskId = self.taskId
+        if taskId is not None:
+          try:
+            queue.renew(taskId, self._workerId)
+          except sqlite3.OperationalError:
+            pass
+    finally:
+      queue.close()
+
+def runWorker(queuePath, workerId=None, leaseTimeout=600.0, pollInterval=1.0, exitWhenIdle=True,
+    maxAttempts=3):
+  """Decides cells from the queue until it is empty (or forever when
+  exitWhenIdle is False); returns the number of decided cells. A cell whose
+  decision raises is marked as failed and the worker goes on."""
+  workerId = workerId or "{}:{}".format(socket.gethostname(), os.getpid())
+  queue = CellQueue(queuePath, leaseTimeout, maxAttempts)
+  heartbeat = _LeaseHeartbeat(queuePath, leaseTimeout, workerId)
+  heartbeat.start()
+  decided = 0
+  try:
+    while True:
+      task = queue.claim(workerId)
+      if task is None:
+        if exitWhenIdle and queue.unfinishedCount() == 0:
+          return decided
+        time.sleep(pollInterval)
+        continue
+      taskId, submissionId, cell = task
+      heartbeat.taskId = taskId
+      try:
+        rule, candidates, voters, committeeSize = queue.loadSubmission(submissionId)
+        exists, record = rule.decideRecordedCell(candidates, voters, committeeSize, cell)
+      except Exception:
+        queue.fail(taskId, "{}: {}".format(workerId, traceback.format_exc()))
+        continue
+      finally:
+        heartbeat.taskId = None
+      record["worker"] = workerId
+      queue.complete(taskId, exists, record)
+      decided = decided + 1
+  finally:
+    heartbeat.stop()
+    queue.close()
+
+def computeDistributed(rule, candidates, voters, mesh, stats, existenceSymbol, queuePath,
+    localWorkers=0, leaseTimeout=600.0, pollInterval=1.0, maxAttempts=3):
+  """The distributed counterpart of rule.compute: enqueues the cells of the
+  mesh, optionally starts localWorkers worker processes and waits until
+  (local or remote) workers decide all the cells. Raises CellTaskError when
+  a cell failed or when all the local workers exited (e.g. were killed)
+  while cells are still undecided."""
+  queue = CellQueue(queuePath, leaseTimeout, maxAttempts)
+  workers = []
+  try:
+    submissionId = queue.submit(rule, candidates, voters, mesh, stats, existenceSymbol)
+    for _ in range(localWorkers):
+      worker = multiprocessing.Process(target=runWorker,
+          kwargs={"queuePath": queuePath, "leaseTimeout": leaseTimeout,
+            "pollInterval": pollInterval, "maxAttempts": maxAttempts})
+      worker.start()
+      workers.append(worker)
+    collected = set()
+    while True:
+      workersExited = bool(workers) and not any(worker.is_alive() for worker in workers)
+      unfinished = queue.collect(submissionId, mesh, existenceSymbol, collected)
+      failures = queue.failures(submissionId)
+      if failures:
+        cell, error = failures[0]
+        raise CellTaskError("{} cells failed, e.g. {}:\n{}".format(len(failures), cell, error))
+      if unfinished == 0:
+        break
+      if workersExited:
+        raise CellTaskError("all local workers exited (exit codes {}) with {} cells "
+            "undecided".format([worker.exitcode for worker in workers], unfinished))
+      time.sleep(pollInterval)
+  except BaseException:
+    for worker in workers:
+      worker.terminate()
+    raise
+  finally:
+    for worker in workers:
+      worker.join()
+    queue.close()
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Worker deciding mesh cells from a shared queue")
+  parser.add_argument("mode", choices=["worker"])
+  parser.add_argument("queuePath")
+  parser.add_argument("--lease-timeout", type=float, default=600.0)
+  parser.add_argument("--poll-interval", type=float, default=1.0)
+  parser.add_argument("--keep-running", action="store_true",
+      help="wait for new cells instead of exiting when the queue is empty")
+  args = parser.parse_args(argv)
+  runWorker(args.queuePath, leaseTimeout=args.lease_timeout, pollInterval=args.poll_interval,
+      exitWhenIdle=not args.keep_running)
+
+if __name__ == "__main__":
+  main()
@@ -3,13 +3,33 @@
 # mul-win-just-pub is licensed under the terms of MIT license
 # see LICENSE.txt for the text of the lincense
 
-import random
-import math
 import csv
+import numpy as np
+import tools
+
+def matrixToVoters(candidates, matrix):
+  """Converts a voters x candidates boolean approval matrix into the voters
+  dict used across the project (voter number -> list of approved candidates)"""
+  labels = np.asarray(candidates)
+  matrix = np.asarray(matrix, dtype=bool)
+  _, cols = np.nonzero(matrix)
+  splits = np.cumsum(np.count_nonzero(matrix, axis=1))[:-1]
+  return {vnr: labels[approved].tolist()
+      for vnr, approved in zip(range(len(matrix)), np.split(cols, splits))}
 
 class VotesGenerator(object):
-  def generate(self, candidates):
+  def __init__(self, seed=None):
+    self._rng = np.random.default_rng(seed)
+
+  def generate(self, candidates, votersnr):
+    candidates, matrix = self.generateMatrix(candidates, votersnr)
+    return candidates, matrixToVoters(candidates, matrix)
+
+  def generateMatrix(self, candidates, votersnr):
+    """Returns candidates and a votersnr x len(candidates) boolean matrix
+    whose columns follow the order of candidates"""
     pass
+
   def description(self):
     pass
 
@@ -18,25 +38,16 @@ class ParameterizedGenerator(VotesGenerator):
     pass
 
 class MallowsModel(ParameterizedGenerator):
-  def __init__(self, inTargetCommitteeProbability, targetCommitteeSize):
+  def __init__(self, inTargetCommitteeProbability, targetCommitteeSize, seed=None):
+    super().__init__(seed)
     self._inTargetCommProb = inTargetCommitteeProbability
     self._targetCommSize = targetCommitteeSize
 
-  def generate(self, candidates, votersnr):
-    def genSingleVoter():
-      vote = []
-      for c in targetCommittee:
-        if random.random() < self._inTargetCommProb:
-          vote.append(c)
-      for c in set(candidates).difference(set(targetCommittee)):
-        if random.random() > self._inTargetCommProb:
-          vote.append(c)
-      return vote
-    targetCommittee = random.sample(candidates, self._targetCommSize)
-    votes = {}
-    for i in range(votersnr):
-      votes[i] = genSingleVoter()
-    return candidates, votes
+  def generateMatrix(self, candidates, votersnr):
+    targetCommittee = self._rng.choice(len(candidates), self._targetCommSize, replace=False)
+    approvalProbabilities = np.full(len(candidates), 1 - self._inTargetCommProb)
+    approvalProbabilities[targetCommittee] = self._inTargetCommProb
+    return candidates, self._rng.random((votersnr, len(candidates))) < approvalProbabilities
 
   def description(self):
     return "Mallows Model, probability: {}, committee size: \
@@ -46,47 +57,30 @@ class MallowsModel(ParameterizedGenerator):
     return (self._inTargetCommProb, self._targetCommSize)
 
 class EqualChooseDistribution(ParameterizedGenerator):
-  def __init__(self, approvalProbability):
+  def __init__(self, approvalProbability, seed=None):
+    super().__init__(seed)
     self._approvalProbability = approvalProbability
 
-  def generate(self, candidates, votersnr):
-    votes = {}
-    for i in range(votersnr):
-      vote = []
-      for c in candidates:
-        if random.random() < self._approvalProbability:
-          vote.append(c)
-      votes[i]=vote
-    return candidates, votes
+  def generateMatrix(self, candidates, votersnr):
+    return candidates, self._rng.random((votersnr, len(candidates))) < self._approvalProbability
   
   def description(self):
     return "Impartial, probability: {}".format(self._approvalProbability)
   
   def parameters(self):
-    return (self._approvalRadius,)
+    return (self._approvalProbability,)
 
 
 class OneDDistribution(ParameterizedGenerator):
-  def __init__(self, approvalRadius):
+  def __init__(self, approvalRadius, seed=None):
+    super().__init__(seed)
     self._approvalRadius = approvalRadius
 
-  def generate(self, candidates, votersnr):
-    votersPositions = []
-    candidatesPositions = []
-    for i in xrange(votersnr):
-      votersPositions.append(random.uniform(0,1))
-    for i in xrange(len(candidates)):
-      candidatesPositions.append(random.uniform(0,1))
-    votes = {}
-    for i in range(votersnr):
-      vote = []
-      maxApproved = votersPositions[i]+self._approvalRadius
-      minApproved = votersPositions[i]-self._approvalRadius
-      for c in xrange(len(candidates)):
-        if candidatesPositions[c] <= maxApproved and candidatesPositions[c] >= minApproved:
-          vote.append(c)
-      votes[i]=vote
-    return candidates, votes
+  def generateMatrix(self, candidates, votersnr):
+    votersPositions = self._rng.uniform(0, 1, votersnr)
+    candidatesPositions = self._rng.uniform(0, 1, len(candidates))
+    distances = np.abs(votersPositions[:, np.newaxis] - candidatesPositions[np.newaxis, :])
+    return candidates, distances <= self._approvalRadius
 
   def description(self):
     return "1D, radius: {}".format(self._approvalRadius)
@@ -96,28 +90,24 @@ class OneDDistribution(ParameterizedGenerator):
 
 
 class TwoDDistribution(ParameterizedGenerator):
-  def __init__(self, approvalRadius):
-    self._approvalRadius = approvalRadius
+  CHUNK_SIZE = 8192
 
-  def generate(self, candidates, votersnr):
+  def __init__(self, approvalRadius, seed=None):
+    super().__init__(seed)
+    self._approvalRadius = approvalRadius
 
-    votersPositions = []
-    candidatesPositions = []
-    for i in xrange(votersnr):
-      votersPositions.append((random.uniform(0,1), random.uniform(0,1)))
-    for i in xrange(len(candidates)):
-      candidatesPositions.append((random.uniform(0,1), random.uniform(0,1)))
-    votes = {}
-    for i in range(votersnr):
-      vote = []
-      vx = votersPositions[i][0]
-      vy = votersPositions[i][1]
-      for c in xrange(len(candidates)):
-        cx = candidatesPositions[c][0]
-        cy = candidatesPositions[c][1]
-        if math.hypot(vx - cx, vy - cy) <= self._approvalRadius:
-          vote.append(c)
-      votes[i]=vote
+  def generateMatrix(self, candidates, votersnr):
+    votersPositions = self._rng.uniform(0, 1, (votersnr, 2))
+    candidatesPositions = self._rng.uniform(0, 1, (len(candidates), 2))
+    squaredRadius = self._approvalRadius*self._approvalRadius
+    votes = np.empty((votersnr, len(candidates)), dtype=bool)
+    # squared distances per coordinate, a chunk of voters at a time, so that
+    # the float temporaries stay small next to the boolean result
+    for start in range(0, votersnr, self.CHUNK_SIZE):
+      chunk = votersPositions[start:start+self.CHUNK_SIZE]
+      squaredDistances = np.square(chunk[:, 0, np.newaxis] - candidatesPositions[np.newaxis, :, 0])
+      squaredDistances += np.square(chunk[:, 1, np.newaxis] - candidatesPositions[np.newaxis, :, 1])
+      np.less_equal(squaredDistances, squaredRadius, out=votes[start:start+self.CHUNK_SIZE])
     return candidates, votes
 
   def description(self):
@@ -126,28 +116,63 @@ class TwoDDistribution(ParameterizedGenerator):
   def parameters(self):
     return (self._approvalRadius,)
     
+class _WeightTree(object):
+  """Fenwick tree over non-negative integer weights; supports updating a
+  weight and finding the index hit by a point of the cumulative weight in
+  O(log n)"""
+  def __init__(self, weights):
+    self._size = len(weights)
+    self._tree = [0] + list(weights)
+    for pos in range(1, self._size + 1):
+      parent = pos + (pos & -pos)
+      if parent <= self._size:
+        self._tree[parent] = self._tree[parent] + self._tree[pos]
+    self._topStep = 1 << (self._size.bit_length() - 1) if self._size > 0 else 0
+    self.total = sum(weights)
+
+  def add(self, index, delta):
+    self.total = self.total + delta
+    pos = index + 1
+    while pos <= self._size:
+      self._tree[pos] = self._tree[pos] + delta
+      pos = pos + (pos & -pos)
+
+  def find(self, point):
+    """Returns the smallest index whose cumulative weight exceeds point"""
+    pos = 0
+    step = self._topStep
+    while step > 0:
+      if pos + step <= self._size and self._tree[pos + step] <= point:
+        pos = pos + step
+        point = point - self._tree[pos]
+      step = step >> 1
+    return pos
+
 class UrnModel(VotesGenerator):
-  def __init__(self, approvalProbability, numberOfReturned):
+  def __init__(self, approvalProbability, numberOfReturned, seed=None):
+    super().__init__(seed)
     self._numberOfReturned = numberOfReturned
     self._approvalProbability = approvalProbability
 
-  def generate(self, candidates, votersnr):
-    urn = list(candidates[:])
-    votes = {}
-    for i in range(votersnr):
-      voteCandidates = 0
-      for c in candidates:
-        if random.random() < self._approvalProbability:
-          voteCandidates = voteCandidates + 1
-      localUrn = urn[:]
+  def generateMatrix(self, candidates, votersnr):
+    """Each voter draws Binomial(|C|, p) distinct candidates from the urn
+    (with probability proportional to their copies in the urn) and returns
+    numberOfReturned extra copies of each of them afterwards"""
+    weights = [1]*len(candidates)
+    urn = _WeightTree(weights)
+    votesSizes = self._rng.binomial(len(candidates), self._approvalProbability, votersnr)
+    draws = iter(self._rng.random(int(votesSizes.sum())).tolist())
+    votes = np.zeros((votersnr, len(candidates)), dtype=bool)
+    for i, voteSize in enumerate(votesSizes.tolist()):
       vote = []
-      for _ in range(voteCandidates):
-        approvedCandidate = random.choice(localUrn)
+      for _ in range(voteSize):
+        approvedCandidate = urn.find(min(int(next(draws)*urn.total), urn.total - 1))
+        urn.add(approvedCandidate, -weights[approvedCandidate])
         vote.append(approvedCandidate)
-        localUrn = [c for c in localUrn if not c == approvedCandidate]
       for c in vote:
-        urn = urn + ([c]*self._numberOfReturned)
-      votes[i] = vote
+        weights[c] = weights[c] + self._numberOfReturned
+        urn.add(c, weights[c])
+      votes[i, vote] = True
     return candidates, votes
 
   def description(self):
@@ -157,42 +182,77 @@ class UrnModel(VotesGenerator):
     return (self._numberOfReturned, self._approvalProbability)
 
 class PabulibElectionBasedDistribution(VotesGenerator):
-  def __init__(self, baseElectionPath):
+  """Samples votes from a pabulib election. The election is parsed once
+  into a CSR-like form (all approved candidate indices concatenated plus
+  per-vote offsets) which is cached on disk next to the source file and
+  memory-mapped on later uses"""
+  CACHE_TAG = "csr"
+  CACHE_ARRAYS = ["candidatesCount", "indices", "offsets"]
+
+  def __init__(self, baseElectionPath, seed=None, useCache=True):
+    super().__init__(seed)
     self._baseElectionPath = baseElectionPath
+    self._useCache = useCache
+    self._election = None
 
   def parameters(self):
     return (None, None)
 
-  def generate(self, candidatesCount, votesCount):
+  def generateMatrix(self, candidatesCount, votesCount):
     """Right now candidatesCount is ignored"""
-    candidates, allVotes = self._parsePabulibElections()
+    election = self._loadElection()
+    candidates = list(range(int(election["candidatesCount"][0])))
+    offsets = election["offsets"]
     #if not candidatesCount == allCandidatesCount:
     #  raise ValueError("Right now one cannot generate pabulib elections"
     #  "with a different number of candidates that they originally have")
-    votes = {}
-    if len(allVotes) < votesCount:
+    if len(offsets) - 1 < votesCount:
       raise ValueError(f"Too small elections to draw {votesCount} votes")
-    for vote in random.sample(allVotes, votesCount):
-      votes[len(votes)] = vote
+    drawn = self._rng.choice(len(offsets) - 1, votesCount, replace=False)
+    starts = offsets[drawn]
+    lengths = offsets[drawn + 1] - starts
+    positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + \
+        np.arange(lengths.sum())
+    votes = np.zeros((votesCount, len(candidates)), dtype=bool)
+    votes[np.repeat(np.arange(votesCount), lengths), election["indices"][positions]] = True
     return candidates, votes
+
   def description(self):
     return f"Pabulib based distribution from: {self._baseElectionPath}"
 
+  def _loadElection(self):
+    if self._election is None:
+      election = None
+      if self._useCache:
+        election = tools.loadArraysCache(self._baseElectionPath, self.CACHE_TAG,
+            self.CACHE_ARRAYS)
+      if election is None:
+        election = self._parsePabulibElections()
+        if self._useCache:
+          tools.saveArraysCacheIfPossible(self._baseElectionPath, self.CACHE_TAG, election)
+      self._election = election
+    return self._election
+
   def _parsePabulibElections(self):
     cand_name_id = {}
-    votes = []
+    indices = []
+    offsets = [0]
     with open(self._baseElectionPath, 'r', newline='', encoding="utf-8") as csvfile:
       reader = csv.reader(csvfile, delimiter=';')
       for row in reader:
         if str(row[0]).strip().lower() in ["meta", "projects", "votes"]:
           section = str(row[0]).strip().lower()
           header = next(reader)
+          if section == "votes":
+            vote_index = header.index("vote")
         elif section == "meta":
           pass
         elif section == "projects":
           cand_name_id[row[0]] = len(cand_name_id);
         elif section == "votes":
-          vote_index = header.index("vote")
-          vote = row[vote_index].strip().split(",") 
-          votes.append([cand_name_id[cand] for cand in vote])
-    return sorted(cand_name_id.values()), votes
+          vote = row[vote_index].strip().split(",")
+          indices.extend(cand_name_id[cand] for cand in vote)
+          offsets.append(len(indices))
+    return {"candidatesCount": np.array([len(cand_name_id)], dtype=np.int64),
+        "indices": np.array(indices, dtype=np.int32),
+        "offsets": np.array(offsets, dtype=np.int64)}
@@ -0,0 +1,296 @@
+#!/usr/bin/python3
+
+# copyright 2020 Andrzej Kaczmarczyk (andrzej >dot> kaczmarczyk <at> agh.edu.pl; a <dot> kaczmarczyk <at> tu-berlin.de)
+# This file is part of mul-win-just-pub.
+# mul-win-just-pub is licensed under the terms of MIT license
+# see LICENSE.txt for the text of the lincense
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import io
+import itertools
+import json
+import logging
+import multiprocessing
+import sys
+import threading
+import time
+import traceback
+import numpy as np
+import distributions
+import instrumentation
+import rules
+import tools
+
+EXISTENCE_SYMBOL = "X"
+
+OK = "ok"
+FAILED = "failed"
+UNFINISHED = "unfinished"
+
+TIME_COLUMNS = ["generationTime", "statsTime", "ruleTime"]
+
+class Job(object):
+  """A single (distribution, rule, committee size, seed) point of a grid.
+  The distribution is given as a name of a class from distributions and
+  the arguments of its constructor; the rule as a name of a class from
+  rules."""
+  def __init__(self, distributionName, distributionArgs, ruleName, committeeSize, seed,
+      candidatesNr, votersNr, coverageParts, approvalParts, cellWorkers=1, instrument=False):
+    self.distributionName = distributionName
+    self.distributionArgs = tuple(distributionArgs)
+    self.ruleName = ruleName
+    self.committeeSize = committeeSize
+    self.seed = seed
+    self.candidatesNr = candidatesNr
+    self.votersNr = votersNr
+    self.coverageParts = coverageParts
+    self.approvalParts = approvalParts
+    self.cellWorkers = cellWorkers
+    self.instrument = instrument
+
+  def distributionDescription(self):
+    return "{}({})".format(self.distributionName, ",".join(str(a) for a in self.distributionArgs))
+
+def buildGrid(distributionSpecs, ruleNames, committeeSizes, seeds, candidatesNr, votersNr,
+    coverageParts, approvalParts, cellWorkers=1, instrument=False):
+  """distributionSpecs is a list of (class name, constructor arguments)
+  pairs; returns jobs for the cartesian product of all the parameters"""
+  return [Job(distName, distArgs, ruleName, committeeSize, seed, candidatesNr, votersNr,
+      coverageParts, approvalParts, cellWorkers, instrument)
+    for (distName, distArgs), ruleName, committeeSize, seed in
+      itertools.product(distributionSpecs, ruleNames, committeeSizes, seeds)]
+
+class _JobRecordsHook(instrumentation.SweepHook):
+  """Tags the records of a job with its distribution and seed and passes
+  them on to eventsQueue as they come (or keeps them when it is None)"""
+  def __init__(self, job, eventsQueue=None):
+    self._job = job
+    self._eventsQueue = eventsQueue
+    self.records = []
+
+  def cellFinished(self, record):
+    record = dict(record, distribution=self._job.distributionDescription(), seed=self._job.seed)
+    if self._eventsQueue is not None:
+      self._eventsQueue.put(record)
+    else:
+      self.records.append(record)
+
+def runJob(job, eventsQueue=None):
+  """Generates the profile of a job, computes its stats and the mesh of its
+  rule; returns the depicted mesh together with the timings"""
+  startTime = time.perf_counter()
+  generator = getattr(distributions, job.distributionName)(*job.distributionArgs, seed=job.seed)
+  candidates, voters = generator.generate(list(range(job.candidatesNr)), job.votersNr)
+  generatedTime = time.perf_counter()
+  stats = rules.ProfileStats(candidates, voters, job.committeeSize)
+  statsTime = time.perf_counter()
+  ruleClass = getattr(rules, job.ruleName)
+  if issubclass(ruleClass, rules.MeshRule):
+    rule = ruleClass(cellWorkers=job.cellWorkers)
+  else:
+    rule = ruleClass()
+  mesh = tools.Mesh(len(candidates), len(voters), job.committeeSize, job.coverageParts,
+      job.approvalParts)
+  hook = _JobRecordsHook(job, eventsQueue)
+  if job.instrument:
+    instrumentation.addHook(hook)
+  try:
+    rule.compute(candidates, voters, mesh, stats, EXISTENCE_SYMBOL)
+  finally:
+    if job.instrument:
+      instrumentation.removeHook(hook)
+  endTime = time.perf_counter()
+  depicted = io.StringIO()
+  mesh.depict(depicted)
+  return {
+      "status": OK,
+      "generationTime": generatedTime - startTime,
+      "statsTime": statsTime - generatedTime,
+      "ruleTime": endTime - statsTime,
+      "mesh": depicted.getvalue(),
+      "grid": mesh.toArray(EXISTENCE_SYMBOL),
+      "records": hook.records}
+
+def _failedResult(error):
+  return {"status": FAILED, "error": error}
+
+def _runJobSafely(job, eventsQueue=None):
+  try:
+    return runJob(job, eventsQueue)
+  except (Exception, SystemExit):
+    return _failedResult(traceback.format_exc())
+
+def iterJobResults(jobs, jobWorkers=1, eventsQueue=None):
+  """Yields (job number, result) pairs as jobs finish; with jobWorkers > 1
+  jobs run in a pool of processes and each idle worker takes the next
+  pending job. With eventsQueue (e.g. from multiprocessing.Manager) the
+  records of instrumented jobs are put there as soon as cells get decided
+  instead of being returned with the results. A job that raises (or whose
+  worker process dies) yields a result with status FAILED and the error
+  instead of stopping the other jobs."""
+  if jobWorkers > 1:
+    with ProcessPoolExecutor(max_workers=jobWorkers) as executor:
+      futures = {executor.submit(_runJobSafely, job, eventsQueue): jobNr
+          for jobNr, job in enumerate(jobs)}
+      for future in as_completed(futures):
+        jobNr = futures.pop(future)
+        try:
+          result = future.result()
+        except (Exception, SystemExit) as error:
+          result = _failedResult(repr(error))
+        yield jobNr, result
+  else:
+    for jobNr, job in enumerate(jobs):
+      yield jobNr, _runJobSafely(job, eventsQueue)
+
+def _writeEvents(eventsQueue, recordsStream):
+  recordsHook = instrumentation.JSONLinesHook(recordsStream)
+  for record in iter(eventsQueue.get, None):
+    recordsHook.cellFinished(record)
+
+def _jobColumns(job):
+  return {
+      "distribution": job.distributionDescription(),
+      "rule": job.ruleName,
+      "committeeSize": job.committeeSize,
+      "seed": job.seed,
+      "candidatesNr": job.candidatesNr,
+      "votersNr": job.votersNr}
+
+def runGrid(jobs, outputPath, jobWorkers=1, recordsStream=None):
+  """Runs jobs (see iterJobResults) and writes one row per job into a
+  compressed columnar .npz file at outputPath; returns the columns. Rows
+  are also appended, as they finish, as JSON lines to outputPath +
+  ".rows.jsonl", and the .npz is written even when the run is interrupted,
+  with the rows of the jobs that did not finish marked as UNFINISHED.
+  Instrumentation records of the jobs are streamed as JSON lines to
+  recordsStream while the jobs run."""
+  results = [None]*len(jobs)
+  if recordsStream is not None:
+    manager = multiprocessing.Manager()
+    eventsQueue = manager.Queue()
+    writer = threading.Thread(target=_writeEvents, args=(eventsQueue, recordsStream))
+    writer.start()
+  else:
+    eventsQueue = None
+  try:
+    with open(outputPath + ".rows.jsonl", 'w') as rowsStream:
+      for jobNr, result in iterJobResults(jobs, jobWorkers, eventsQueue):
+        result.pop("grid", None)
+        result.pop("records", None)
+        results[jobNr] = result
+        if result["status"] != OK:
+          logging.warning("job %s failed:\n%s", jobNr, result["error"])
+        row = _jobColumns(jobs[jobNr])
+        row.update(result, job=jobNr)
+        rowsStream.write(json.dumps(row) + "\n")
+        rowsStream.flush()
+  finally:
+    if eventsQueue is not None:
+      eventsQueue.put(None)
+      writer.join()
+      manager.shutdown()
+    columns = _gridColumns(jobs, results)
+    np.savez_compressed(outputPath, **columns)
+  return columns
+
+def _gridColumns(jobs, results):
+  results = [result if result is not None else {"status": UNFINISHED, "error": ""}
+      for result in results]
+  columns = {
+      "distribution": np.array([job.distributionDescription() for job in jobs]),
+      "rule": np.array([job.ruleName for job in jobs]),
+      "committeeSize": np.array([job.committeeSize for job in jobs], dtype=np.int32),
+      "seed": np.array([job.seed for job in jobs], dtype=np.int64),
+      "candidatesNr": np.array([job.candidatesNr for job in jobs], dtype=np.int32),
+      "votersNr": np.array([job.votersNr for job in jobs], dtype=np.int32),
+      "status": np.array([result["status"] for result in results]),
+      "error": np.array([result.get("error", "") for result in results])}
+  for name in TIME_COLUMNS:
+    columns[name] = np.array([result.get(name, np.nan) for result in results], dtype=np.float64)
+  columns["mesh"] = np.array([result.get("mesh", "") for result in results])
+  return columns
+
+def aggregateKey(job):
+  return "{} {}".format(job.distributionDescription(), job.ruleName)
+
+def aggregateGrid(jobs, jobWorkers=1):
+  """Runs jobs (see iterJobResults) sharing the number of candidates,
+  voters, committee size and mesh parts, and sums the meshes of the jobs
+  that succeeded into an AggregateMesh (one heatmap per distribution and
+  rule, see aggregateKey) as they arrive; returns the aggregate and the
+  numbers of the jobs that failed"""
+  first = jobs[0]
+  aggregate = tools.AggregateMesh(first.candidatesNr, first.votersNr, first.committeeSize,
+      first.coverageParts, first.approvalParts)
+  failedJobs = []
+  for jobNr, result in iterJobResults(jobs, jobWorkers):
+    if result["status"] != OK:
+      logging.warning("job %s failed, skipping it:\n%s", jobNr, result["error"])
+      failedJobs.append(jobNr)
+      continue
+    aggregate.addGrid(aggregateKey(jobs[jobNr]), result["grid"])
+  return aggregate, sorted(failedJobs)
+
+def _parseDistributionArg(arg):
+  for parse in (int, float):
+    try:
+      return parse(arg)
+    except ValueError:
+      pass
+  return arg
+
+def _parseDistributionSpec(spec):
+  """Parses e.g. "OneDDistribution:0.05" into ("OneDDistribution", (0.05,));
+  arguments that are not numbers (e.g. a path of a Pabulib file) stay strings"""
+  name, _, args = spec.partition(":")
+  return name, tuple(_parseDistributionArg(arg) for arg in args.split(",") if arg)
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Computes meshes for a grid of "
+      "distributions, rules, committee sizes and seeds")
+  parser.add_argument("--distribution", action="append", required=True,
+      help="class from distributions with its arguments, e.g. OneDDistribution:0.05")
+  parser.add_argument("--rule", action="append", required=True, help="class from rules")
+  parser.add_argument("--committee-sizes", type=int, nargs="+", required=True)
+  parser.add_argument("--seeds", type=int, nargs="+", default=[0])
+  parser.add_argument("--candidates", type=int, required=True)
+  parser.add_argument("--voters", type=int, required=True)
+  parser.add_argument("--coverage-parts", type=int, default=10)
+  parser.add_argument("--approval-parts", type=int, default=10)
+  parser.add_argument("--job-workers", type=int, default=1)
+  parser.add_argument("--cell-workers", type=int, default=1)
+  parser.add_argument("--output", required=True, help="path of the resulting .npz file")
+  parser.add_argument("--aggregate", action="store_true",
+      help="store per distribution and rule frequency heatmaps over all jobs instead of every mesh "
+      "(requires a single committee size)")
+  parser.add_argument("--records", help="path of a JSON lines file for per-cell "
+      "instrumentation records (see instrumentation.py)")
+  args = parser.parse_args(argv)
+  jobs = buildGrid([_parseDistributionSpec(spec) for spec in args.distribution], args.rule,
+      args.committee_sizes, args.seeds, args.candidates, args.voters, args.coverage_parts,
+      args.approval_parts, args.cell_workers, args.records is not None)
+  if args.aggregate:
+    if len(args.committee_sizes) != 1:
+      parser.error("--aggregate requires a single committee size")
+    aggregate, failedJobs = aggregateGrid(jobs, args.job_workers)
+    aggregate.save(args.output)
+    for key in aggregate.getKeys():
+      print("{} ({} profiles)".format(key, aggregate.getProfilesCount(key)))
+      aggregate.depictHeatmap(key, sys.stdout)
+    notOk = len(failedJobs)
+  else:
+    if args.records is not None:
+      with open(args.records, 'w') as recordsStream:
+        columns = runGrid(jobs, args.output, args.job_workers, recordsStream)
+    else:
+      columns = runGrid(jobs, args.output, args.job_workers)
+    notOk = int(np.sum(columns["status"] != OK))
+  if notOk > 0:
+    print("{} of {} jobs did not finish successfully".format(notOk, len(jobs)), file=sys.stderr)
+    return 1
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
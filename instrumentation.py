@@ -0,0 +1,174 @@
+#!/usr/bin/python3
+
+# copyright 2020 Andrzej Kaczmarczyk (andrzej >dot> kaczmarczyk <at> agh.edu.pl; a <dot> kaczmarczyk <at> tu-berlin.de)
+# This file is part of mul-win-just-pub.
+# mul-win-just-pub is licensed under the terms of MIT license
+# see LICENSE.txt for the text of the lincense
+
+"""Per-cell instrumentation of mesh sweeps.
+
+Rules open a record for every cell they decide (see recording); while it is
+active, baseProgram, isxJRChecker and the rules add phase times and counters
+to it, as well as the verdict and the committee witnessing it. Finished
+records are passed as dicts to the registered hooks as soon as the mesh is
+updated with the verdict (see progress for consumers). Both the active
+record and the hooks belong to the current context (thread or asyncio task),
+so concurrent sweeps do not see each other's records."""
+
+import contextlib
+import contextvars
+import json
+import sys
+import time
+
+PHASES = ["build", "solve", "checker", "branching"]
+
+_hooks = contextvars.ContextVar("hooks", default=())
+_activeRecord = contextvars.ContextVar("activeRecord", default=None)
+
+class CellRecord(object):
+  def __init__(self, rule, cell, context):
+    self.rule = rule
+    self.cell = cell
+    self.context = context
+    self.times = {phase: 0.0 for phase in PHASES}
+    self.totalTime = 0.0
+    self.rows = 0
+    self.columns = 0
+    self.nonzeros = 0
+    self.nodes = 0
+    self.cutIterations = 0
+    self.checkerILPs = 0
+    self.branches = 0
+    self.exists = None
+    self.committee = None
+
+  def asDict(self):
+    record = dict(self.context)
+    record.update({
+      "rule": self.rule,
+      "cell": list(self.cell) if self.cell is not None else None,
+      "totalTime": self.totalTime,
+      "rows": self.rows,
+      "columns": self.columns,
+      "nonzeros": self.nonzeros,
+      "nodes": self.nodes,
+      "cutIterations": self.cutIterations,
+      "checkerILPs": self.checkerILPs,
+      "branches": self.branches,
+      "exists": self.exists,
+      "committee": self.committee})
+    for phase, phaseTime in self.times.items():
+      record[phase + "Time"] = phaseTime
+    return record
+
+class SweepHook(object):
+  def cellFinished(self, record):
+    pass
+
+class JSONLinesHook(SweepHook):
+  def __init__(self, outStream):
+    self._outStream = outStream
+
+  def cellFinished(self, record):
+    self._outStream.write(json.dumps(record) + "\n")
+    self._outStream.flush()
+
+class CollectingHook(SweepHook):
+  def __init__(self):
+    self.records = []
+
+  def cellFinished(self, record):
+    self.records.append(record)
+
+def addHook(hook):
+  _hooks.set(_hooks.get() + (hook,))
+
+def removeHook(hook):
+  hooks = list(_hooks.get())
+  hooks.remove(hook)
+  _hooks.set(tuple(hooks))
+
+def notify(record):
+  for hook in _hooks.get():
+    hook.cellFinished(record)
+
+@contextlib.contextmanager
+def recording(rule, cell, **context):
+  """Makes a new CellRecord the active one for the duration of the block"""
+  record = CellRecord(rule, cell, context)
+  token = _activeRecord.set(record)
+  startTime = time.perf_counter()
+  try:
+    yield record
+  finally:
+    record.totalTime = time.perf_counter() - startTime
+    _activeRecord.reset(token)
+
+@contextlib.contextmanager
+def phase(name):
+  startTime = time.perf_counter()
+  try:
+    yield
+  finally:
+    addTime(name, time.perf_counter() - startTime)
+
+def addTime(name, seconds):
+  record = _activeRecord.get()
+  if record is not None:
+    record.times[name] = record.times[name] + seconds
+
+def count(field, amount=1):
+  record = _activeRecord.get()
+  if record is not None:
+    setattr(record, field, getattr(record, field) + amount)
+
+def isRecording():
+  return _activeRecord.get() is not None
+
+def recordCommittee(committee):
+  """Stores the committee witnessing the verdict of the active cell"""
+  record = _activeRecord.get()
+  if record is not None:
+    record.committee = list(committee)
+
+def recordModel(model):
+  """Stores the size of a solved gurobi model and adds its B&B nodes"""
+  record = _activeRecord.get()
+  if record is None:
+    return
+  record.rows = max(record.rows, model.NumConstrs)
+  record.columns = max(record.columns, model.NumVars)
+  record.nonzeros = max(record.nonzeros, model.NumNZs)
+  try:
+    record.nodes = record.nodes + int(model.NodeCount)
+  except Exception:
+    pass
+
+def loadRecords(inputPath):
+  with open(inputPath, 'r') as infile:
+    return [json.loads(line) for line in infile if line.strip()]
+
+def summarize(records, outStream, slowest=10):
+  """Writes the share of time per phase and the slowest cells"""
+  totalTime = sum(record["totalTime"] for record in records)
+  outStream.write("{} cells, {:.3f}s in total\n".format(len(records), totalTime))
+  phasesTime = 0.0
+  for phaseName in PHASES:
+    phaseTime = sum(record[phaseName + "Time"] for record in records)
+    phasesTime = phasesTime + phaseTime
+    outStream.write("  {:<10} {:10.3f}s {:6.1%}\n".format(phaseName, phaseTime,
+      phaseTime/totalTime if totalTime > 0 else 0.0))
+  otherTime = totalTime - phasesTime
+  outStream.write("  {:<10} {:10.3f}s {:6.1%}\n".format("other", otherTime,
+    otherTime/totalTime if totalTime > 0 else 0.0))
+  outStream.write("slowest cells:\n")
+  for record in sorted(records, key=lambda record: -record["totalTime"])[:slowest]:
+    outStream.write("  {:.3f}s {} {} build {:.3f}s solve {:.3f}s checker {:.3f}s, "
+      "{} rows, {} columns, {} nonzeros, {} nodes, {} cut iterations, {} checker ILPs\n".format(
+      record["totalTime"], record["rule"], record["cell"], record["buildTime"],
+      record["solveTime"], record["checkerTime"], record["rows"], record["columns"],
+      record["nonzeros"], record["nodes"], record["cutIterations"], record["checkerILPs"]))
+
+if __name__ == "__main__":
+  summarize(loadRecords(sys.argv[1]), sys.stdout)
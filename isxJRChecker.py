@@ -6,8 +6,20 @@
 # see LICENSE.txt for the text of the lincense
 
 from pulp import *
+import instrumentation
 import math
 
+_solver = None
+
+def setSolver(solver):
+  '''Sets the PuLP solver used by the ILP checkers; None restores the
+     default GUROBI one'''
+  global _solver
+  _solver = solver
+
+def _getSolver():
+  return _solver if _solver is not None else GUROBI(msg=0)
+
 def appListToBinaryVector(voter, candidates):
   v = [1 if c in voter else 0 for c in candidates]
   return v
@@ -89,8 +101,10 @@ def isPJR_ilp( V, W ):
 
   for ell in range(1,k+1):
 #    print "Testing PJR", ell
-    (model,X,Y) = pjr_ilp( V, W, ell )
-    model.solve(GUROBI(msg=0))
+    with instrumentation.phase("checker"):
+      (model,X,Y) = pjr_ilp( V, W, ell )
+      model.solve(_getSolver())
+    instrumentation.count("checkerILPs")
     if( model.status == 1 ):
 #      print "NO PJR"
       return False  
@@ -118,8 +132,10 @@ def isEJR_ilp( V, W ):
 
   for ell in range(1,k+1):
 #    print "Testing EJR", ell
-    (model,X,Y) = ejr_ilp( V, W, ell )
-    model.solve(GUROBI(msg=0))
+    with instrumentation.phase("checker"):
+      (model,X,Y) = ejr_ilp( V, W, ell )
+      model.solve(_getSolver())
+    instrumentation.count("checkerILPs")
     if( model.status == 1 ):
 #      print "NO EJR"
       return False  # comment out for the ILP to provide explanation about failing EJR
@@ -0,0 +1,113 @@
+# copyright 2020 Andrzej Kaczmarczyk (andrzej >dot> kaczmarczyk <at> agh.edu.pl; a <dot> kaczmarczyk <at> tu-berlin.de)
+# This file is part of mul-win-just-pub.
+# mul-win-just-pub is licensed under the terms of MIT license
+# see LICENSE.txt for the text of the lincense
+
+"""Consumers of the cell events (instrumentation records) emitted by rules
+while they sweep a mesh: a JSON lines writer (instrumentation.JSONLinesHook),
+an incrementally redrawn text rendering of a mesh and an asyncio stream."""
+
+import asyncio
+import contextvars
+import threading
+import instrumentation
+
+PENDING_SYMBOL = "?"
+
+class MeshRenderer(instrumentation.SweepHook):
+  """Redraws the mesh (as Mesh.depict does, with undecided cells shown as
+  PENDING_SYMBOL) every time one of its cells is decided. On terminals the
+  previous drawing is overwritten, otherwise drawings are appended."""
+  def __init__(self, mesh, outStream, rule=None, ansi=None):
+    self._mesh = mesh
+    self._outStream = outStream
+    self._rule = rule
+    self._ansi = outStream.isatty() if ansi is None else ansi
+    self._decided = set()
+    self._drawnLines = 0
+
+  def cellFinished(self, record):
+    if record["cell"] is None or record.get("committeeSize") != self._mesh.committeeSize:
+      return
+    if self._rule is not None and record["rule"] != self._rule:
+      return
+    self._decided.add(tuple(record["cell"]))
+    self.redraw()
+
+  def redraw(self):
+    unclipped = set(self._mesh.getUnclippedCells())
+    lines = []
+    row = []
+    for cell in self._mesh.getAllCells():
+      if cell in unclipped and cell not in self._decided:
+        row.append(PENDING_SYMBOL)
+      else:
+        row.append(str(self._mesh.getValueOfCell(cell, None)))
+      if len(row) == self._mesh.approvalParts:
+        lines.append("".join(row))
+        row = []
+    if row:
+      lines.append("".join(row))
+    lines.append("decided {}/{} cells".format(len(self._decided & unclipped), len(unclipped)))
+    if self._ansi and self._drawnLines > 0:
+      self._outStream.write("\x1b[{}F".format(self._drawnLines))
+    self._outStream.write("\n".join(lines) + "\n")
+    self._outStream.flush()
+    self._drawnLines = len(lines)
+
+class _StreamClosed(Exception):
+  pass
+
+class _AsyncQueueHook(instrumentation.SweepHook):
+  """Passes records to an asyncio queue; once closed is set it raises
+  _StreamClosed instead, which stops the sweep at the next decided cell"""
+  def __init__(self, loop, queue, closed):
+    self._loop = loop
+    self._queue = queue
+    self._closed = closed
+
+  def cellFinished(self, record):
+    if self._closed.is_set():
+      raise _StreamClosed()
+    self._loop.call_soon_threadsafe(self._queue.put_nowait, record)
+
+async def streamCells(rule, candidates, voters, mesh, stats, existenceSymbol):
+  """Runs rule.compute in a worker thread and asynchronously yields the cell
+  records as the cells get decided:
+
+    async for record in progress.streamCells(rule, candidates, voters, mesh, stats, "X"):
+      ...
+
+  The computation runs in a copy of the current context with the stream's
+  hook added, so concurrent streams only get the records of their own rule.
+  Leaving the stream early stops the sweep after the cell being decided (so
+  the mesh stays partially filled); exceptions of rule.compute are raised
+  either way. Closing the stream with contextlib.aclosing makes both happen
+  right away instead of when the generator gets finalized:
+
+    async with contextlib.aclosing(progress.streamCells(...)) as records:
+      async for record in records:
+        if hopeless(record):
+          break
+  """
+  loop = asyncio.get_running_loop()
+  queue = asyncio.Queue()
+  finished = object()
+  closed = threading.Event()
+  context = contextvars.copy_context()
+  context.run(instrumentation.addHook, _AsyncQueueHook(loop, queue, closed))
+  computation = loop.run_in_executor(None, context.run, rule.compute, candidates, voters, mesh,
+      stats, existenceSymbol)
+  computation.add_done_callback(lambda _: queue.put_nowait(finished))
+  try:
+    while True:
+      record = await queue.get()
+      if record is finished:
+        break
+      yield record
+  finally:
+    closed.set()
+    try:
+      await computation
+    except _StreamClosed:
+      pass
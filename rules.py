@@ -4,109 +4,241 @@
 # see LICENSE.txt for the text of the lincense
 
 from baseProgram import compute, COVERAGE_MAX, APPROVAL_MAX, compute_pav
+from baseProgram import COVERAGE_MIN, APPROVAL_MIN, COMM_OF_GIVEN_SIZE, SweepModel
 from baseProgram import COMPUTE_PJR, COMPUTE_EJR, computeEJRorPJR
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from gmpy2 import mpq
+import functools
+import instrumentation
 import sys
 import tools
 
-class JRCommittee(object):
+class ProfileStats(object):
+  """Extreme coverage and approval scores among all committees and among JR
+  committees of a given size; rules use them to clip their meshes. With a
+  SweepModel of the profile (for committee sizes up to at least
+  committeeSize) the extremes are solved on it instead of on new models."""
+  def __init__(self, candidates, voters, committeeSize, model=None):
+    if model is not None:
+      model.setCommitteeSize(committeeSize)
+      model.setCell(1, committeeSize*len(voters), 1, len(voters))
+    def extreme(goal, requireJR):
+      if model is not None:
+        model.setRequireJR(requireJR)
+        model.setGoal(goal)
+        return model.solve()[1]
+      return compute(candidates, voters, 1, committeeSize*len(voters), 1, len(voters),
+          committeeSize, goal=goal, requireJR=requireJR)[1]
+    self.minCov = extreme(COVERAGE_MIN, False)
+    self.maxCov = extreme(COVERAGE_MAX, False)
+    self.minApp = extreme(APPROVAL_MIN, False)
+    self.maxApp = extreme(APPROVAL_MAX, False)
+    self.minJRCov = extreme(COVERAGE_MIN, True)
+    self.maxJRCov = extreme(COVERAGE_MAX, True)
+    self.minJRApp = extreme(APPROVAL_MIN, True)
+    self.maxJRApp = extreme(APPROVAL_MAX, True)
+
+class MeshRule(object):
+  """A rule that decides each unclipped cell of a mesh independently.
+  With cellWorkers > 1 the cells are solved in a pool of processes."""
+  missingSymbol = '.'
+
+  def __init__(self, cellWorkers=1):
+    self.cellWorkers = cellWorkers
+
   def compute(self, candidates, voters, mesh, stats, existenceSymbol):
-    committeeSize = mesh.committeeSize
+    self.prepare(candidates, voters, mesh, stats, existenceSymbol)
+    self.sweep(candidates, voters, mesh, existenceSymbol)
+
+  def prepare(self, candidates, voters, mesh, stats, existenceSymbol):
+    """Everything that has to happen before the cells are decided"""
+    self.clip(mesh, stats)
+
+  def clip(self, mesh, stats):
+    pass
+
+  def decideCell(self, candidates, voters, committeeSize, cell):
+    pass
+
+  def decideRecordedCell(self, candidates, voters, committeeSize, cell):
+    with instrumentation.recording(type(self).__name__, cell,
+        committeeSize=committeeSize) as record:
+      exists = self.decideCell(candidates, voters, committeeSize, cell)
+      record.exists = bool(exists)
+    return exists, record.asDict()
+
+  def setVerdict(self, mesh, cell, exists, existenceSymbol, record):
+    """Writes the verdict of a cell into the mesh and then passes its record
+    to the instrumentation hooks"""
+    if exists:
+      mesh.setValueOfCell(cell, existenceSymbol)
+    elif self.missingSymbol is not None:
+      mesh.setValueOfCell(cell, self.missingSymbol)
+    instrumentation.notify(record)
+
+  def sweep(self, candidates, voters, mesh, existenceSymbol):
+    cells = mesh.getUnclippedCells()
+    decide = functools.partial(self.decideRecordedCell, candidates, voters,
+        mesh.committeeSize)
+    if self.cellWorkers > 1:
+      with ProcessPoolExecutor(max_workers=self.cellWorkers) as executor:
+        futures = {executor.submit(decide, cell): cell for cell in cells}
+        try:
+          for future in as_completed(futures):
+            exists, record = future.result()
+            self.setVerdict(mesh, futures.pop(future), exists, existenceSymbol, record)
+        except BaseException:
+          # e.g. a hook stopping the sweep; do not decide the remaining cells
+          for future in futures:
+            future.cancel()
+          raise
+    else:
+      for cell in cells:
+        exists, record = decide(cell)
+        self.setVerdict(mesh, cell, exists, existenceSymbol, record)
+
+  def computeForCommitteeSizes(self, candidates, voters, meshes, stats, existenceSymbol):
+    """meshes and stats are dicts keyed by committee sizes"""
+    for committeeSize in sorted(meshes):
+      self.compute(candidates, voters, meshes[committeeSize], stats[committeeSize],
+          existenceSymbol)
+
+class SharedModelRule(MeshRule):
+  """A rule deciding a cell by the feasibility of _basicModel for the given
+  goal, requireJR and (optionally) an EJR/PJR check of the found committee.
+  Over many committee sizes all cells share a single SweepModel; each cell
+  starts from the last committee found, extended by the most approved
+  candidates (or shrunk by the least approved ones) when k changes."""
+  goal = COMM_OF_GIVEN_SIZE
+  requireJR = True
+  whatToCompute = None
+
+  def decideCell(self, candidates, voters, committeeSize, cell):
+    lc, uc, la, ua = cell
+    if self.whatToCompute is None:
+      return compute(candidates, voters, la, ua, lc, uc, committeeSize, goal = self.goal,
+          requireJR = self.requireJR)[0]
+    return computeEJRorPJR(candidates, voters, la, ua, lc, uc, committeeSize,
+        self.whatToCompute, goal = self.goal)[0]
+
+  def computeForCommitteeSizes(self, candidates, voters, meshes, stats, existenceSymbol,
+      model=None):
+    """meshes and stats are dicts keyed by committee sizes; cells are
+    solved sequentially (cellWorkers is ignored) as they share one model,
+    which may be given (e.g. the one stats were computed with)"""
+    ruleName = type(self).__name__
+    committeeSizes = sorted(meshes)
+    if model is None:
+      with instrumentation.recording(ruleName, None, committeeSize=committeeSizes) as record:
+        with instrumentation.phase("build"):
+          model = SweepModel(candidates, voters, max(committeeSizes), self.requireJR)
+      instrumentation.notify(record.asDict())
+    model.setRequireJR(self.requireJR)
+    model.setGoal(self.goal)
+    approvals = {c: 0 for c in candidates}
+    for vote in voters.values():
+      for c in vote:
+        approvals[c] = approvals[c] + 1
+    byApprovals = sorted(candidates, key=lambda c: -approvals[c])
+    knownCommittee = None
+    for committeeSize in committeeSizes:
+      mesh = meshes[committeeSize]
+      self.clip(mesh, stats[committeeSize])
+      model.setCommitteeSize(committeeSize)
+      if knownCommittee is not None:
+        knownCommittee = self._resizeCommittee(knownCommittee, committeeSize, byApprovals)
+      for cell in mesh.getUnclippedCells():
+        lc, uc, la, ua = cell
+        with instrumentation.recording(ruleName, cell, committeeSize=committeeSize) as record:
+          model.setCell(la, ua, lc, uc)
+          if knownCommittee is not None:
+            model.setStart(knownCommittee)
+          exists, _, committee = model.solve(self.whatToCompute)
+          record.exists = exists
+        if exists:
+          knownCommittee = committee
+        self.setVerdict(mesh, cell, exists, existenceSymbol, record.asDict())
+
+  def _resizeCommittee(self, committee, committeeSize, byApprovals):
+    members = set(committee)
+    committee = [c for c in byApprovals if c in members][:committeeSize]
+    for c in byApprovals:
+      if len(committee) >= committeeSize:
+        break
+      if c not in committee:
+        committee.append(c)
+    return committee
+
+class JRCommittee(SharedModelRule):
+  def clip(self, mesh, stats):
     mesh.clipMeshByValues(stats.minJRCov, stats.maxJRCov, stats.minJRApp, stats.maxJRApp)
 
-    for cell in mesh.getUnclippedCells():
-      lc, uc, la, ua = cell
-      toOut='.'
-#      print(lc, uc, la, ua )
-      if compute(candidates, voters, la, ua, lc, uc, committeeSize)[0]:
-        toOut=existenceSymbol
-      mesh.setValueOfCell(cell, toOut)
+class PJRCommittee(SharedModelRule):
+  whatToCompute = COMPUTE_PJR
 
-class PJRCommittee(object):
-  def compute(self, candidates, voters, mesh, stats, existenceSymbol):
-    committeeSize = mesh.committeeSize
+  def clip(self, mesh, stats):
     mesh.clipMeshByValues(stats.minJRCov, stats.maxJRCov, stats.minJRApp, stats.maxJRApp)
 
-    for cell in mesh.getUnclippedCells():
-      lc, uc, la, ua = cell
-      toOut='.'
-      if computeEJRorPJR(candidates, voters, la, ua, lc, uc, committeeSize, COMPUTE_PJR)[0]:
-        toOut=existenceSymbol
-      mesh.setValueOfCell(cell, toOut)
+class AnyCommittee(SharedModelRule):
+  goal = APPROVAL_MAX
+  requireJR = False
 
-class AnyCommittee(object):
-  def compute(self, candidates, voters, mesh, stats, existenceSymbol):
-    committeeSize = mesh.committeeSize
+  def clip(self, mesh, stats):
     mesh.clipMeshByValues(stats.minCov, stats.maxCov, stats.minApp, stats.maxApp)
 
-    for cell in mesh.getUnclippedCells():
-      lc, uc, la, ua = cell
-      toOut='.'
-#      print(lc, uc, la, ua )
-      if compute(candidates, voters, la, ua, lc, uc, committeeSize, goal =
-          APPROVAL_MAX, requireJR = False)[0]:
-        toOut=existenceSymbol
-      mesh.setValueOfCell(cell, toOut)
-
-class MaxApprovalCommittee(object):
-  def compute(self, candidates, voters, mesh, stats, existenceSymbol):
-    committeeSize = mesh.committeeSize
+class MaxApprovalCommittee(SharedModelRule):
+  goal = COVERAGE_MAX
+  requireJR = False
+
+  def clip(self, mesh, stats):
     mesh.clipMeshByValues(stats.minCov, stats.maxCov, stats.maxApp, stats.maxApp)
 
-    for cell in mesh.getUnclippedCells():
-      lc, uc, la, ua = cell
-      toOut='.'
-#      print(lc, uc, la, ua )
-      if compute(candidates, voters, la, ua, lc, uc, committeeSize, goal =
-          COVERAGE_MAX, requireJR = False)[0]:
-        toOut=existenceSymbol
-      mesh.setValueOfCell(cell, toOut)
-
-class ChambelinCourantCommittee(object):
-  def compute(self, candidates, voters, mesh, stats, existenceSymbol):
-    committeeSize = mesh.committeeSize
+class ChambelinCourantCommittee(SharedModelRule):
+  requireJR = False
+
+  def clip(self, mesh, stats):
     mesh.clipMeshByValues(stats.maxCov, stats.maxCov, stats.minApp, stats.maxApp)
 
-    for cell in mesh.getUnclippedCells():
-      lc, uc, la, ua = cell
-      toOut='.'
-#      print(lc, uc, la, ua )
-      if compute(candidates, voters, la, ua, lc, uc, committeeSize, requireJR = False)[0]:
-        toOut=existenceSymbol
-      mesh.setValueOfCell(cell, toOut)
+class PAV(MeshRule):
+  missingSymbol = None
 
-class PAV(object):
-  def compute(self, candidates, voters, mesh, stats, existenceSymbol):
-    committeeSize = mesh.committeeSize
-    mesh.clipMeshByValues(stats.minJRCov, stats.maxJRCov, stats.minJRApp, stats.maxJRApp)
+  def prepare(self, candidates, voters, mesh, stats, existenceSymbol):
+    self.clip(mesh, stats)
+    self._maxSatisfaction = SinglePAV().compute(candidates, voters, mesh, stats, existenceSymbol)
 
-    maxSatisfaction = SinglePAV().compute(candidates, voters, mesh, stats, existenceSymbol)
+  def clip(self, mesh, stats):
+    mesh.clipMeshByValues(stats.minJRCov, stats.maxJRCov, stats.minJRApp, stats.maxJRApp)
 
-    for cell in mesh.getUnclippedCells():
-      lc, uc, la, ua = cell
-#      print(lc, uc, la, ua )
-      if compute_pav(candidates, voters, la, ua, lc, uc, committeeSize,
-          satisfactionLevel=maxSatisfaction)[0]:
-        mesh.setValueOfCell(cell, existenceSymbol)
+  def decideCell(self, candidates, voters, committeeSize, cell):
+    lc, uc, la, ua = cell
+    return compute_pav(candidates, voters, la, ua, lc, uc, committeeSize,
+        satisfactionLevel=self._maxSatisfaction)[0]
 
 class SinglePAV(object):
   def compute(self, candidates, voters, mesh, stats, existenceSymbol):
     committeeSize = mesh.committeeSize
-    success, satisfaction, _, coverage, approval = compute_pav(candidates, voters,
-        stats.minJRApp, stats.maxJRApp, stats.minJRCov, stats.maxJRCov,
-        committeeSize)
+    with instrumentation.recording(type(self).__name__, None,
+        committeeSize=committeeSize) as record:
+      success, satisfaction, _, coverage, approval = compute_pav(candidates, voters,
+          stats.minJRApp, stats.maxJRApp, stats.minJRCov, stats.maxJRCov,
+          committeeSize)
+      record.exists = bool(success)
     if success:
       mesh.setValueOfCell(mesh.getCellFromValues(coverage, approval), existenceSymbol)
+    instrumentation.notify(record.asDict())
     return satisfaction
 
 class SequentialPhragmen(object):
 
   def compute(self, candidates, voters, mesh, stats, existenceSymbol):
-    committees = self.computeAllCommittees(candidates, voters, mesh.committeeSize)
-    committeesWithAppAndCoverage = []
-    for committee in committees:
-      approvals, coverage = tools.committeApprovalAndCoverage(candidates, voters, committee)
-      committeesWithAppAndCoverage.append((committee, approvals, coverage))
+    with instrumentation.recording(type(self).__name__, None,
+        committeeSize=mesh.committeeSize) as record:
+      with instrumentation.phase("branching"):
+        committees = self.computeAllCommittees(candidates, voters, mesh.committeeSize)
+    instrumentation.notify(record.asDict())
+    coverages, approvals, _, _ = tools.committeesStatistics(
+        tools.votersToMatrix(candidates, voters), tools.committeesToMatrix(candidates, committees))
+    committeesWithAppAndCoverage = list(zip(committees, coverages.tolist(), approvals.tolist()))
     self.depictMesh(committeesWithAppAndCoverage, existenceSymbol, mesh)
 
 
@@ -127,8 +259,7 @@ class SequentialPhragmen(object):
       for pref in preferences.values():
         appr.update(set(pref))
       if len(appr) < committeeSize:
-        print("committeesize is larger than number of approved candidates")
-        exit()
+        raise ValueError("committeesize is larger than number of approved candidates")
 
     __enough_approved_candiates()
 
@@ -161,6 +292,7 @@ class SequentialPhragmen(object):
                         else:
                             new_load[vnr] = load[vnr]
                     com_loads_next[tuple(sorted(committee + (c,)))] = new_load
+        instrumentation.count("branches", len(com_loads_next))
         # remove suboptimal committees, leave only the best branching_factor many (subject to ties)
         com_loads = {}
         cutoff = min([max(load) for load in com_loads_next.values()])
@@ -168,3 +300,25 @@ class SequentialPhragmen(object):
             if max(load) <= cutoff:
                 com_loads[com] = load
     return [set(comm) for comm in com_loads.keys()]
+
+
+def computeMeshes(rule, candidates, voters, committeeSizes, coverageParts, approvalParts,
+    existenceSymbol):
+  """Computes one mesh per committee size; the stats of all committee sizes
+  are solved on a single SweepModel, which rules able to share work across
+  committee sizes (see SharedModelRule) reuse for their cells. Returns a
+  committee size -> Mesh dict."""
+  meshes = {committeeSize: tools.Mesh(len(candidates), len(voters), committeeSize,
+    coverageParts, approvalParts) for committeeSize in committeeSizes}
+  model = SweepModel(candidates, voters, max(committeeSizes), True)
+  stats = {committeeSize: ProfileStats(candidates, voters, committeeSize, model)
+    for committeeSize in sorted(meshes)}
+  if isinstance(rule, SharedModelRule):
+    rule.computeForCommitteeSizes(candidates, voters, meshes, stats, existenceSymbol, model)
+  elif isinstance(rule, MeshRule):
+    rule.computeForCommitteeSizes(candidates, voters, meshes, stats, existenceSymbol)
+  else:
+    for committeeSize in sorted(meshes):
+      rule.compute(candidates, voters, meshes[committeeSize], stats[committeeSize],
+          existenceSymbol)
+  return meshes
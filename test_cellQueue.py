@@ -0,0 +1,77 @@
+# copyright 2020 Andrzej Kaczmarczyk (andrzej >dot> kaczmarczyk <at> agh.edu.pl; a <dot> kaczmarczyk <at> tu-berlin.de)
+# This file is part of mul-win-just-pub.
+# mul-win-just-pub is licensed under the terms of MIT license
+# see LICENSE.txt for the text of the lincense
+
+"""Distributed sweeps (cellQueue) against in-process ones; needs gurobipy:
+
+  python -m pytest test_cellQueue.py"""
+
+import io
+import os
+import pytest
+
+pytest.importorskip("gurobipy")
+
+import cellQueue
+import distributions
+import rules
+import tools
+
+COMMITTEE_SIZE = 3
+
+class _AbandoningRule(object):
+  """Wraps a rule so that the first worker to decide a cell dies without
+  completing it (once per markerPath), leaving an abandoned lease behind"""
+  def __init__(self, rule, markerPath):
+    self._rule = rule
+    self._markerPath = markerPath
+
+  def prepare(self, candidates, voters, mesh, stats, existenceSymbol):
+    self._rule.prepare(candidates, voters, mesh, stats, existenceSymbol)
+
+  def setVerdict(self, mesh, cell, exists, existenceSymbol, record=None):
+    self._rule.setVerdict(mesh, cell, exists, existenceSymbol, record)
+
+  def decideRecordedCell(self, candidates, voters, committeeSize, cell):
+    try:
+      os.close(os.open(self._markerPath, os.O_CREAT | os.O_EXCL))
+    except FileExistsError:
+      return self._rule.decideRecordedCell(candidates, voters, committeeSize, cell)
+    os._exit(1)
+
+class _RaisingRule(rules.JRCommittee):
+  def decideCell(self, candidates, voters, committeeSize, cell):
+    raise ValueError("cannot decide {}".format(cell))
+
+def _profile():
+  candidates, voters = distributions.EqualChooseDistribution(0.3, seed=0).generate(
+      list(range(8)), 16)
+  return candidates, voters, rules.ProfileStats(candidates, voters, COMMITTEE_SIZE)
+
+def _newMesh(candidates, voters):
+  return tools.Mesh(len(candidates), len(voters), COMMITTEE_SIZE, 4, 4)
+
+def _depicted(mesh):
+  outStream = io.StringIO()
+  mesh.depict(outStream)
+  return outStream.getvalue()
+
+@pytest.mark.parametrize("ruleClass", [rules.JRCommittee, rules.PJRCommittee])
+def test_abandonedLeaseIsDecidedAgain(ruleClass, tmp_path):
+  candidates, voters, stats = _profile()
+  expected = _newMesh(candidates, voters)
+  ruleClass().compute(candidates, voters, expected, stats, "X")
+  mesh = _newMesh(candidates, voters)
+  rule = _AbandoningRule(ruleClass(), str(tmp_path / "died"))
+  cellQueue.computeDistributed(rule, candidates, voters, mesh, stats, "X",
+      str(tmp_path / "queue.sqlite"), localWorkers=3, leaseTimeout=1.0, pollInterval=0.1)
+  assert os.path.exists(str(tmp_path / "died"))
+  assert _depicted(mesh) == _depicted(expected)
+
+def test_failedCellRaises(tmp_path):
+  candidates, voters, stats = _profile()
+  with pytest.raises(cellQueue.CellTaskError, match="cannot decide"):
+    cellQueue.computeDistributed(_RaisingRule(), candidates, voters,
+        _newMesh(candidates, voters), stats, "X", str(tmp_path / "queue.sqlite"),
+        localWorkers=2, leaseTimeout=1.0, pollInterval=0.1)
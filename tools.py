@@ -3,6 +3,12 @@
 # mul-win-just-pub is licensed under the terms of MIT license
 # see LICENSE.txt for the text of the lincense
 
+import logging
+import os
+import shutil
+import tempfile
+import numpy as np
+
 def committeApprovalAndCoverage(candidates, voters, committee):
   commSet = set(committee)
   coverageCounter=0
@@ -16,50 +22,217 @@ def committeApprovalAndCoverage(candidates, voters, committee):
         approvalCounter = approvalCounter + 1
   return coverageCounter, approvalCounter
 
-def loadPrefLibPartialOrder(filepath, groupsApproved):
+def votersToMatrix(candidates, voters):
+  """Voters x candidates boolean approval matrix of the voters dict, rows
+  ordered as voters.keys() and columns as candidates"""
+  columns = {cand: column for column, cand in enumerate(candidates)}
+  matrix = np.zeros((len(voters), len(columns)), dtype=bool)
+  for row, vote in enumerate(voters.values()):
+    matrix[row, [columns[cand] for cand in vote]] = True
+  return matrix
+
+def committeesToMatrix(candidates, committees):
+  """Committees x candidates boolean indicator matrix"""
+  return votersToMatrix(candidates, dict(enumerate(committees)))
+
+def votersToPackedMatrix(candidates, voters, chunkSize=1024):
+  """votersToMatrix with rows bit-packed (np.packbits(..., axis=1)), built
+  chunkSize voters at a time so the dense matrix never exists"""
+  columns = {cand: column for column, cand in enumerate(candidates)}
+  votes = list(voters.values())
+  packed = np.empty((len(votes), (len(columns) + 7)//8), dtype=np.uint8)
+  for start in range(0, len(votes), chunkSize):
+    chunk = np.zeros((len(votes[start:start+chunkSize]), len(columns)), dtype=bool)
+    for row, vote in enumerate(votes[start:start+chunkSize]):
+      chunk[row, [columns[cand] for cand in vote]] = True
+    packed[start:start+chunkSize] = np.packbits(chunk, axis=1)
+  return packed
+
+def _packedStatistics(approvals, approvalsPacked, committees, chunkSize, dtype, harmonic):
+  packedCommittees = np.packbits(committees, axis=1)
+  satisfaction = np.empty((len(approvals), len(committees)), dtype=dtype)
+  coverage = np.zeros(len(committees), dtype=np.int64)
+  approval = np.zeros(len(committees), dtype=np.int64)
+  pav = np.zeros(len(committees), dtype=np.float64)
+  for start in range(0, len(approvals), chunkSize):
+    if approvalsPacked:
+      packedApprovals = np.asarray(approvals[start:start+chunkSize], dtype=np.uint8)
+    else:
+      packedApprovals = np.packbits(np.asarray(approvals[start:start+chunkSize], dtype=bool),
+          axis=1)
+    common = packedApprovals[:, np.newaxis, :] & packedCommittees[np.newaxis, :, :]
+    if hasattr(np, "bitwise_count"):
+      bits = np.bitwise_count(common)
+    else:
+      bits = _BYTE_POPCOUNT[common]
+    counts = bits.sum(axis=2, dtype=dtype)
+    satisfaction[start:start+chunkSize] = counts
+    coverage += np.count_nonzero(counts, axis=0)
+    approval += counts.sum(axis=0, dtype=np.int64)
+    pav += harmonic[counts].sum(axis=0)
+  return coverage, approval, pav, satisfaction
+
+_BYTE_POPCOUNT = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.uint8)
+
+def committeesStatistics(approvals, committees, packed=False, chunkSize=1024,
+    approvalsPacked=False):
+  """Computes statistics of many committees at once. approvals is a voters x
+  candidates 0/1 matrix and committees a committees x candidates 0/1
+  matrix. Returns (coverage, approval, pav, satisfaction): the number of
+  voters approving some member, the approval score and the PAV score of
+  every committee, and the voters x committees matrix of the numbers of
+  approved members. With packed=True rows are bit-packed and processed
+  chunkSize voters at a time, which bounds the memory on large profiles;
+  with approvalsPacked=True (implying packed) approvals are rows already
+  packed by np.packbits(..., axis=1), e.g. from votersToPackedMatrix."""
+  committees = np.asarray(committees, dtype=bool)
+  maxSize = int(committees.sum(axis=1).max()) if len(committees) else 0
+  dtype = np.min_scalar_type(maxSize)
+  harmonic = np.concatenate(([0.0], np.cumsum(1.0/np.arange(1, maxSize+1))))
+  if packed or approvalsPacked:
+    return _packedStatistics(approvals, approvalsPacked, committees, chunkSize, dtype, harmonic)
+  approvals = np.asarray(approvals, dtype=bool)
+  satisfaction = (approvals.astype(np.float32) @ committees.T.astype(np.float32)).astype(dtype)
+  coverage = np.count_nonzero(satisfaction, axis=0)
+  approval = satisfaction.sum(axis=0, dtype=np.int64)
+  pav = harmonic[satisfaction].sum(axis=0)
+  return coverage, approval, pav, satisfaction
+
+def _arrayCachePointerPath(sourcePath, tag):
+  return "{}.{}.cache".format(sourcePath, tag)
+
+def saveArraysCache(sourcePath, tag, arrays):
+  """Stores arrays (a name -> numpy array dict) as .npy files in a fresh
+  directory next to sourcePath so that loadArraysCache can memory-map them
+  later. The directory becomes visible only once all the arrays are written,
+  by atomically replacing a pointer file naming it, so concurrent readers see
+  either the previous or the new set of arrays. Raises OSError when the
+  cache cannot be written."""
+  pointerPath = _arrayCachePointerPath(sourcePath, tag)
+  cacheDir = tempfile.mkdtemp(prefix=os.path.basename(pointerPath) + ".",
+      dir=os.path.dirname(os.path.abspath(pointerPath)))
+  try:
+    for name, array in arrays.items():
+      with open(os.path.join(cacheDir, name + ".npy"), 'wb') as outfile:
+        np.save(outfile, np.ascontiguousarray(array))
+    previousDir = _readArrayCachePointer(pointerPath)
+    tmpPointerPath = "{}.{}.tmp".format(pointerPath, os.getpid())
+    with open(tmpPointerPath, 'w') as outfile:
+      outfile.write(os.path.basename(cacheDir))
+    os.replace(tmpPointerPath, pointerPath)
+  except BaseException:
+    shutil.rmtree(cacheDir, ignore_errors=True)
+    raise
+  if previousDir is not None and previousDir != cacheDir:
+    shutil.rmtree(previousDir, ignore_errors=True)
+
+def _readArrayCachePointer(pointerPath):
+  try:
+    with open(pointerPath, 'r') as infile:
+      cacheDirName = infile.read().strip()
+  except OSError:
+    return None
+  if not cacheDirName or os.sep in cacheDirName:
+    return None
+  return os.path.join(os.path.dirname(os.path.abspath(pointerPath)), cacheDirName)
+
+def loadArraysCache(sourcePath, tag, names):
+  """Returns a name -> memory-mapped array dict or None if the cache is
+  missing, incomplete or older than sourcePath"""
+  pointerPath = _arrayCachePointerPath(sourcePath, tag)
+  try:
+    if os.path.getmtime(pointerPath) < os.path.getmtime(sourcePath):
+      return None
+    cacheDir = _readArrayCachePointer(pointerPath)
+    if cacheDir is None:
+      return None
+    return {name: np.load(os.path.join(cacheDir, name + ".npy"), mmap_mode='r')
+        for name in names}
+  except (OSError, ValueError):
+    return None
+
+def saveArraysCacheIfPossible(sourcePath, tag, arrays):
+  """saveArraysCache that only logs a warning when the cache cannot be
+  written (e.g. a read-only data directory or a full disk)"""
+  try:
+    saveArraysCache(sourcePath, tag, arrays)
+  except OSError as error:
+    logging.warning("cannot cache arrays of %s: %s", sourcePath, error)
+
+def _parsePrefLibOrder(order, groupsApproved):
+  """Returns the (0-based) candidates from the first groupsApproved groups
+  of a PrefLib order such as "1,{2,3},4" or "{},5" """
+  approved = []
+  groupsSeen = 0
+  inGroup = False
+  for part in order.split(","):
+    if groupsSeen >= groupsApproved:
+      break
+    part = part.strip()
+    if part.startswith("{"):
+      inGroup = True
+      part = part[1:]
+    closesGroup = part.endswith("}")
+    if closesGroup:
+      part = part[:-1]
+    if part != "":
+      approved.append(int(part)-1)
+    if closesGroup or not inGroup:
+      groupsSeen = groupsSeen + 1
+      inGroup = False
+  return approved
+
+def _readPrefLibHeader(infile):
+  candnr = int(infile.readline().strip())
+  for _ in range(candnr):
+    infile.readline()
+  votersnr = int(infile.readline().strip().split(",")[0])
+  return candnr, votersnr
+
+def _iterPrefLibBallots(infile, groupsApproved):
+  for line in infile:
+    line = line.strip()
+    if line == "":
+      continue
+    multiplicity, _, order = line.partition(",")
+    yield _parsePrefLibOrder(order, groupsApproved), int(multiplicity)
+
+def iterPrefLibPartialOrder(filepath, groupsApproved):
+  """Yields (approved candidates, multiplicity) pairs of a PrefLib
+  partial-order (soc/soi/toc) file one ballot at a time; the approved
+  candidates are those from the first groupsApproved groups"""
+  with open(filepath, 'r') as infile:
+    _readPrefLibHeader(infile)
+    yield from _iterPrefLibBallots(infile, groupsApproved)
+
+def loadPrefLibPartialOrder(filepath, groupsApproved, useCache=True):
+  cacheTag = "preflib{}".format(groupsApproved)
+  cacheArrays = ["candidatesCount", "indices", "offsets", "multiplicities"]
+  cached = loadArraysCache(filepath, cacheTag, cacheArrays) if useCache else None
+  if cached is not None:
+    candnr = int(cached["candidatesCount"][0])
+    indices = cached["indices"].tolist()
+    offsets = cached["offsets"].tolist()
+    profile = {vnr: indices[offsets[vnr]:offsets[vnr+1]] for vnr in range(len(offsets)-1)}
+    multiplicities = dict(enumerate(cached["multiplicities"].tolist()))
+    return profile, range(candnr), multiplicities
+
   profile = {}
   multiplicities = {}
   with open(filepath, 'r') as infile:
-    counter = 0
-    votersnr = None
-    candnr = None
-    for line in infile:
-      counter = counter + 1
-      if counter == 1:
-        candnr = int(line.strip())
-        continue
-      if counter > 1 and counter <= candnr + 1:
-        continue
-      if counter == candnr + 2:
-        votersnr = int(line.strip().split(",")[0])
-        continue
-      lineparts = line.strip().split(",")
-      multiplicity = int(lineparts[0])
-      groups = {}
-      partnr = 1
-#      print lineparts
-      while partnr <= len(lineparts[1:]):
-        part = lineparts[partnr]
-        if part == "{}" or part == "":
-          groupApproved = []
-        elif part.startswith("{"):
-          endpartnr = partnr
-          while not lineparts[endpartnr].endswith("}"):
-            endpartnr = endpartnr + 1
-          groupApproved = reduce(lambda acc, elem: acc + [int(elem)-1],
-              (",".join(lineparts[partnr:endpartnr+1])[1:-1]).split(","), [])
-          partnr = endpartnr
-        else:
-          groupApproved = [int(part)-1]
-        groups[len(groups)] = groupApproved
-        partnr = partnr + 1
-
-      approved = reduce(lambda acc, elem: acc + elem, [g for gnr, g in
-        groups.items() if gnr<groupsApproved], [])
-
+    candnr, _ = _readPrefLibHeader(infile)
+    for approved, multiplicity in _iterPrefLibBallots(infile, groupsApproved):
       nextVoteNr = len(profile)
       profile[nextVoteNr] = approved
       multiplicities[nextVoteNr] = multiplicity
+  if useCache:
+    lengths = [len(approved) for approved in profile.values()]
+    saveArraysCacheIfPossible(filepath, cacheTag, {
+      "candidatesCount": np.array([candnr], dtype=np.int64),
+      "indices": np.fromiter((c for approved in profile.values() for c in approved),
+        dtype=np.int32, count=sum(lengths)),
+      "offsets": np.concatenate(([0], np.cumsum(lengths, dtype=np.int64))),
+      "multiplicities": np.array([multiplicities[vnr] for vnr in profile], dtype=np.int64)})
   return profile, range(candnr), multiplicities
 
 
@@ -121,6 +294,25 @@ class Mesh(object):
       if cCLB <= coverage and cCUB >= coverage and cALB <= approval and cAUB >= approval:
         return cell
 
+  def _initializeGridPositions(self):
+    coverageLowerBounds = sorted({cell[0] for cell in self._cells}, reverse=True)
+    approvalLowerBounds = sorted({cell[2] for cell in self._cells})
+    self.gridShape = (len(coverageLowerBounds), len(approvalLowerBounds))
+    self._gridPosition = {cell: (coverageLowerBounds.index(cell[0]),
+      approvalLowerBounds.index(cell[2])) for cell in self._cells}
+
+  def getGridPosition(self, cell):
+    """(row, column) of the cell as drawn by depict, starting from 0"""
+    return self._gridPosition[cell]
+
+  def toArray(self, value):
+    """Boolean grid (in the layout of depict) marking the cells holding value"""
+    grid = np.zeros(self.gridShape, dtype=bool)
+    for cell, cellValue in self._cells.items():
+      if cellValue == value:
+        grid[self._gridPosition[cell]] = True
+    return grid
+
   def getCellCoordinate(self, cell):
     return self._cellCoordinate[cell]
 
@@ -162,5 +354,67 @@ class Mesh(object):
     self._maxCoverage = votersNr
     self._initializeCells()
     self._initializeCellsCoordinates()
+    self._initializeGridPositions()
+
+
+class AggregateMesh(object):
+  """Accumulates, per key (e.g. a distribution and a rule), how many of
+  the aggregated profiles have a committee in each cell of a mesh layout.
+  Only a count grid per key is kept, so memory does not depend on the
+  number of profiles."""
+
+  HEATMAP_LEVELS = " .:-=+*#%@"
+
+  def __init__(self, candidatesNr, votersNr, committeeSize, coverageParts, approvalParts):
+    self.layout = Mesh(candidatesNr, votersNr, committeeSize, coverageParts, approvalParts)
+    self._counts = {}
+    self._profiles = {}
+
+  def addGrid(self, key, grid):
+    """Adds a boolean grid of one profile (see Mesh.toArray)"""
+    if key not in self._counts:
+      self._counts[key] = np.zeros(self.layout.gridShape, dtype=np.int64)
+      self._profiles[key] = 0
+    self._counts[key] += np.asarray(grid, dtype=bool)
+    self._profiles[key] = self._profiles[key] + 1
+
+  def addMesh(self, key, mesh, existenceSymbol):
+    self.addGrid(key, mesh.toArray(existenceSymbol))
+
+  def merge(self, other):
+    for key, counts in other._counts.items():
+      if key not in self._counts:
+        self._counts[key] = np.zeros(self.layout.gridShape, dtype=np.int64)
+        self._profiles[key] = 0
+      self._counts[key] += counts
+      self._profiles[key] = self._profiles[key] + other._profiles[key]
+
+  def getKeys(self):
+    return sorted(self._counts)
+
+  def getProfilesCount(self, key):
+    return self._profiles[key]
+
+  def getCounts(self, key):
+    return self._counts[key]
+
+  def getFrequencies(self, key):
+    """Fraction of the aggregated profiles having a committee in each cell"""
+    return self._counts[key] / max(self._profiles[key], 1)
+
+  def depictHeatmap(self, key, outStream):
+    levels = self.HEATMAP_LEVELS
+    for row in self.getFrequencies(key):
+      outStream.write("".join(levels[int(round(freq*(len(levels)-1)))] for freq in row))
+      outStream.write("\n")
+
+  def save(self, outputPath):
+    """Writes counts and frequencies of every key into an .npz file"""
+    arrays = {}
+    for key in self.getKeys():
+      arrays["{}.counts".format(key)] = self._counts[key]
+      arrays["{}.frequencies".format(key)] = self.getFrequencies(key)
+      arrays["{}.profiles".format(key)] = np.array([self._profiles[key]])
+    np.savez_compressed(outputPath, **arrays)
 
 